@@ -1,71 +1,348 @@
+import io
 import os
-from flask import Flask, render_template, request, redirect, url_for, send_file
-from docx import Document
-from htmldocx import HtmlToDocx
-import requests
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from flask import Flask, render_template, request, redirect, url_for, send_file, abort, jsonify
+from jobs import JobQueue, QueueFull
+from cache import ResultCache, image_cache, new_fragment_cache
+from limits import BudgetExceeded, ConversionBudget
+from stats import ConversionStats
+from httpfetch import fetcher
+from urllib.parse import urlparse
 import logging
 
 app = Flask(__name__)
 
 script_dir = os.path.dirname(os.path.realpath(__file__))
 
+DOCX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+RESULT_TTL = 600
+MAX_RESULTS = 256
+JOB_WORKERS = int(os.environ.get('HTML2DOCX_JOB_WORKERS', 2))
+JOB_MAX_PENDING = int(os.environ.get('HTML2DOCX_JOB_MAX_PENDING', 16))
+JOB_BACKEND = os.environ.get('HTML2DOCX_JOB_BACKEND', 'thread')
+ASYNC_THRESHOLD = int(os.environ.get('HTML2DOCX_ASYNC_THRESHOLD', 1024 * 1024))
+RESULT_CACHE_BYTES = int(os.environ.get('HTML2DOCX_RESULT_CACHE_BYTES', 64 * 1024 * 1024))
+RESULT_CACHE_DIR = os.environ.get('HTML2DOCX_RESULT_CACHE_DIR')
+# uploads up to this size are read whole so they can hit the result cache;
+# larger ones are streamed
+CACHED_UPLOAD_BYTES = int(os.environ.get('HTML2DOCX_CACHED_UPLOAD_BYTES', 1024 * 1024))
+METRICS_ENABLED = os.environ.get('HTML2DOCX_METRICS', '1') != '0'
+# interactive downloads favour save speed over size
+COMPRESS_LEVEL = int(os.environ.get('HTML2DOCX_COMPRESS_LEVEL', 1))
+STORE_IMAGES = os.environ.get('HTML2DOCX_STORE_IMAGES', '1') != '0'
+# editors resubmit whole documents; unchanged blocks come from this cache
+# (0 turns incremental conversion off)
+FRAGMENT_CACHE_BYTES = int(os.environ.get('HTML2DOCX_FRAGMENT_CACHE_BYTES', 32 * 1024 * 1024))
+# large documents are split by section over this many processes (0 or 1
+# converts every document on the request's own thread)
+SECTION_WORKERS = int(os.environ.get('HTML2DOCX_SECTION_WORKERS', os.cpu_count() or 1))
+# limits for one conversion of submitted HTML (0 turns a limit off); with
+# HTML2DOCX_PARTIAL_RESULTS=1 a document over a limit comes back truncated
+# instead of failing
+DEADLINE = float(os.environ.get('HTML2DOCX_DEADLINE', 60))
+MAX_INPUT_BYTES = int(os.environ.get('HTML2DOCX_MAX_INPUT_BYTES', 50 * 1024 * 1024))
+MAX_ELEMENTS = int(os.environ.get('HTML2DOCX_MAX_ELEMENTS', 1000000))
+MAX_TABLE_CELLS = int(os.environ.get('HTML2DOCX_MAX_TABLE_CELLS', 100000))
+MAX_TOTAL_IMAGE_BYTES = int(os.environ.get('HTML2DOCX_MAX_TOTAL_IMAGE_BYTES', 200 * 1024 * 1024))
+MAX_DEPTH = int(os.environ.get('HTML2DOCX_MAX_DEPTH', 256))
+PARTIAL_RESULTS = os.environ.get('HTML2DOCX_PARTIAL_RESULTS', '0') != '0'
+# the converter (python-docx, lxml, bs4) is loaded on the first request;
+# HTML2DOCX_WARMUP=1 loads it and runs a sample conversion at startup
+WARMUP = os.environ.get('HTML2DOCX_WARMUP', '0') != '0'
+
+
+# What a route needs of a conversion, small enough to pickle back from a
+# job process: the document bytes and, when a partial budget cut the
+# conversion short, why it stopped (None for a complete document).
+Converted = namedtuple('Converted', 'content partial')
+
+
+class ResultStore:
+    # Converted documents parked in memory between the POST and the
+    # /download/<token> that follows the redirect.
+
+    def __init__(self, ttl=RESULT_TTL, max_results=MAX_RESULTS):
+        self.ttl = ttl
+        self.max_results = max_results
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def put(self, converted):
+        token = secrets.token_urlsafe(16)
+        now = time.monotonic()
+        with self._lock:
+            for key in [k for k, (_, expires) in self._results.items() if expires < now]:
+                del self._results[key]
+            while len(self._results) >= self.max_results:
+                del self._results[next(iter(self._results))]
+            self._results[token] = (converted, now + self.ttl)
+        return token
+
+    def get(self, token):
+        with self._lock:
+            entry = self._results.get(token)
+        if entry is None or entry[1] < time.monotonic():
+            return None
+        return entry[0]
+
+
+results = ResultStore()
+jobs = JobQueue(workers=JOB_WORKERS, max_pending=JOB_MAX_PENDING, backend=JOB_BACKEND,
+               ttl=RESULT_TTL, max_finished=MAX_RESULTS)
+result_cache = ResultCache(RESULT_CACHE_BYTES, path=RESULT_CACHE_DIR)
+fragment_cache = new_fragment_cache(FRAGMENT_CACHE_BYTES) if FRAGMENT_CACHE_BYTES else None
+# conversion stats summed over every conversion run in this process; jobs
+# on the process backend run elsewhere and are not included
+metrics = ConversionStats()
+metrics_lock = threading.Lock()
+budget = ConversionBudget(
+    deadline=DEADLINE or None,
+    input_bytes=MAX_INPUT_BYTES or None,
+    elements=MAX_ELEMENTS or None,
+    table_cells=MAX_TABLE_CELLS or None,
+    image_bytes=MAX_TOTAL_IMAGE_BYTES or None,
+    depth=MAX_DEPTH or None,
+    partial=PARTIAL_RESULTS,
+)
+# created on the first large document
+section_executor = None
+section_lock = threading.Lock()
+warmup_seconds = None
+
+
+def converter():
+    import htmldocx
+    return htmldocx
+
+def warmup():
+    global warmup_seconds
+    warmup_seconds = converter().warmup(options={'compress-level': COMPRESS_LEVEL, 'store-images': STORE_IMAGES})
+    return warmup_seconds
+
+
+@app.errorhandler(BudgetExceeded)
+def budget_exceeded(e):
+    return 'Error: %s' % e, 413
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
 
-@app.route('/completed')
-def completed():
-    return render_template('completed.html')
+@app.route('/completed/<token>')
+def completed(token):
+    converted = results.get(token)
+    if converted is None:
+        abort(404)
+    return render_template('completed.html', token=token, partial=converted.partial)
+
+def new_parser():
+    parser = converter().HtmlToDocx()
+    parser.result_cache = result_cache
+    parser.fragment_cache = fragment_cache
+    parser.instrument = METRICS_ENABLED
+    parser.options['compress-level'] = COMPRESS_LEVEL
+    parser.options['store-images'] = STORE_IMAGES
+    parser.budget = budget
+    return parser
+
+def record(stats):
+    if stats is not None:
+        with metrics_lock:
+            metrics.add('conversions')
+            metrics.merge(stats)
+
+def section_pool():
+    global section_executor
+    with section_lock:
+        if section_executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            section_executor = ProcessPoolExecutor(max_workers=SECTION_WORKERS)
+        return section_executor
 
 def convert_html_to_docx(html_content):
-    doc = Document()
-    html_parser = HtmlToDocx()
-    html_parser.parse_html_string(html_content)
-    return doc
+    parser = new_parser()
+    if SECTION_WORKERS > 1 and len(html_content) >= converter().PARALLEL_MIN_CHARS:
+        result = parser.convert_parallel(html_content, workers=SECTION_WORKERS, executor=section_pool())
+    elif fragment_cache is not None:
+        result = parser.convert_incremental(html_content)
+    else:
+        result = parser.convert(html_content)
+    record(result.stats)
+    return Converted(result.content, str(result.error) if result.partial else None)
+
+def convert_stream_to_docx(source):
+    parser = new_parser()
+    output = io.BytesIO()
+    parser.convert_stream(source, output)
+    record(parser.stats)
+    return Converted(output.getvalue(), str(parser.budget_error) if parser.budget_error is not None else None)
+
+def normalize_url(url):
+    if not urlparse(url).scheme:
+        url = "https://" + url
+    return url
+
+def fetch_html(url):
+    response = fetcher.fetch(url)
+    if response.status_code != 200:
+        raise ValueError('Could not retrieve URL content (HTTP %d)' % response.status_code)
+    return response
+
+def convert_url_to_docx(url):
+    # an unchanged page (served from the fetcher after a 304) hashes to the
+    # same result cache entry, so it is not converted again
+    return convert_html_to_docx(fetch_html(url).text)
+
+def convert_file_to_docx(path):
+    try:
+        with open(path, 'rb') as infile:
+            return convert_stream_to_docx(infile)
+    finally:
+        os.remove(path)
+
+def wants_async(size=0):
+    return bool(request.values.get('async')) or size > ASYNC_THRESHOLD
+
+def enqueue(fn, *args, cleanup=None):
+    # cleanup() releases what args hold when the job is turned away; once
+    # accepted, fn owns them
+    try:
+        job = jobs.submit(fn, *args)
+    except QueueFull:
+        if cleanup is not None:
+            cleanup()
+        response = jsonify(error='Conversion queue is full, retry later')
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+    response = jsonify(
+        job_id=job.id,
+        status_url=url_for('job_status', job_id=job.id),
+        result_url=url_for('job_result', job_id=job.id),
+    )
+    response.status_code = 202
+    return response
+
+def send_docx(converted):
+    response = send_file(io.BytesIO(converted.content), mimetype=DOCX_MIMETYPE, as_attachment=True,
+                         download_name='output.docx')
+    if converted.partial is not None:
+        # the document stops where a conversion limit was reached
+        response.headers['X-Conversion-Partial'] = converted.partial
+    return response
+
+def respond_with(converted):
+    # ?download=1 streams the document back in this response, as the forms
+    # on the index page ask for. Otherwise it is kept under a short-lived
+    # token for the completed page; the token lives in this process's
+    # memory, so that flow needs every request served by one process.
+    if request.values.get('download'):
+        return send_docx(converted)
+    return redirect(url_for('completed', token=results.put(converted)))
 
 @app.route('/convert', methods=['POST'])
 def convert():
     html_content = request.form['html_content']
-    doc = convert_html_to_docx(html_content)
-    output_file = os.path.join(script_dir, 'static', 'output.docx')
-    return redirect(url_for('completed'))
+    if wants_async(len(html_content)):
+        return enqueue(convert_html_to_docx, html_content)
+    return respond_with(convert_html_to_docx(html_content))
 
 @app.route('/upload', methods=['POST'])
 def upload():
     uploaded_file = request.files['file']
     if uploaded_file:
-        html_content = uploaded_file.read().decode('utf-8')
-        doc = convert_html_to_docx(html_content)
-        output_file = os.path.join(script_dir, 'static', 'output.docx')
-    return redirect(url_for('completed'))
+        if wants_async(request.content_length or 0):
+            # the upload stream is gone once this request ends
+            fd, path = tempfile.mkstemp(suffix='.html')
+            try:
+                with os.fdopen(fd, 'wb') as spool:
+                    shutil.copyfileobj(uploaded_file.stream, spool)
+            except BaseException:
+                os.remove(path)
+                raise
+            return enqueue(convert_file_to_docx, path, cleanup=lambda: os.remove(path))
+        if request.content_length and request.content_length <= CACHED_UPLOAD_BYTES:
+            html_content = uploaded_file.stream.read().decode('utf-8', errors='replace')
+            return respond_with(convert_html_to_docx(html_content))
+        return respond_with(convert_stream_to_docx(uploaded_file.stream))
+    return redirect(url_for('index'))
 
 @app.route('/convert_url', methods=['POST'])
 def convert_url():
     try:
-        url = request.form['url']
-        if("https://" not in url):
-            url = "https://" + url
-        response = requests.get(url)
-        if response.status_code == 200:
-            html_content = response.text
-            doc = convert_html_to_docx(html_content)
-            output_file = os.path.join(script_dir, 'static', 'output.docx')
-            return redirect(url_for('completed'))
-        else:
+        url = normalize_url(request.form['url'])
+        if wants_async():
+            return enqueue(convert_url_to_docx, url)
+        try:
+            converted = convert_url_to_docx(url)
+        except BudgetExceeded as e:
+            return budget_exceeded(e)
+        except ValueError:
             return 'Error: Could not retrieve URL content'
+        return respond_with(converted)
     except Exception as e:
         print(str(e))
         return 'Error: Could not convert URL'
 
-@app.route('/download')
-def download():
+@app.route('/download/<token>')
+def download(token):
+    converted = results.get(token)
+    if converted is None:
+        abort(404)
     try:
-        output_file = os.path.join(script_dir, 'static', 'output.docx')
-        return send_file(output_file, as_attachment=True)
+        return send_docx(converted)
     except Exception as e:
         logging.exception(f'Error downloading file: {e}')
         return 'Error: Could not download file'
 
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    status = job.to_dict()
+    if job.state == 'done':
+        status['result_url'] = url_for('job_result', job_id=job.id)
+        status['partial'] = job.result.partial
+    return jsonify(status)
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    if job.state == 'failed':
+        return jsonify(job.to_dict()), 500
+    if job.state != 'done':
+        return jsonify(job.to_dict()), 409
+    return send_docx(job.result)
+
+@app.route('/metrics')
+def show_metrics():
+    with metrics_lock:
+        conversions = metrics.to_dict()
+    return jsonify(
+        conversions=conversions,
+        result_cache=result_cache.stats(),
+        fragment_cache=fragment_cache.stats() if fragment_cache is not None else None,
+        image_cache=image_cache.stats(),
+        fetcher=fetcher.stats(),
+        jobs={'pending': jobs.pending(), 'backend': JOB_BACKEND},
+        warmup_seconds=warmup_seconds,
+    )
+
+@app.route('/warmup', methods=['POST'])
+def warm():
+    return jsonify(seconds=warmup())
+
+if WARMUP:
+    warmup()
+
 if __name__ == '__main__':
     app.run(debug=False, host='0.0.0.0')
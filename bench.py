@@ -0,0 +1,436 @@
+import argparse
+import base64
+import http.server
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+
+from bs4 import BeautifulSoup
+
+import htmldocx
+from htmldocx import HtmlToDocx, template_cache
+
+
+DEFAULT_SEED = 1234
+DEFAULT_SCALE = 1
+DEFAULT_REPEAT = 3
+TARGETS = ('parse_html_string', 'parse_html_file', 'add_html_to_document')
+WORDS = (
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod '
+    'tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam '
+    'quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo'
+).split()
+COLORS = ('red', 'blue', 'green', '#336699', 'rgb(200, 30, 30)', 'orange')
+# each runs in a fresh interpreter and prints the seconds of the step named
+COLD_START_CASES = {
+    'import_htmldocx': 'started = time.perf_counter()\nimport htmldocx\n',
+    'import_app': 'started = time.perf_counter()\nimport app\n',
+    'first_convert': (
+        'import htmldocx\nstarted = time.perf_counter()\n'
+        'htmldocx.HtmlToDocx().convert(htmldocx.WARMUP_HTML)\n'
+    ),
+    'warmup': 'import htmldocx\nstarted = time.perf_counter()\nhtmldocx.warmup()\n',
+    'convert_after_warmup': (
+        'import htmldocx\nhtmldocx.warmup()\nstarted = time.perf_counter()\n'
+        'htmldocx.HtmlToDocx().convert(htmldocx.WARMUP_HTML)\n'
+    ),
+}
+
+
+def png(width, height, rgb):
+    # a solid-colour PNG, so the corpus needs no imaging library
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    row = b'\0' + bytes(rgb) * width
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(row * height))
+            + chunk(b'IEND', b''))
+
+
+class Corpus:
+    # Deterministic documents: the same seed and scale always produce the
+    # same HTML, so runs on different commits are comparable.
+
+    def __init__(self, seed=DEFAULT_SEED, scale=DEFAULT_SCALE, image_base=None, image_dir=None):
+        self.seed = seed
+        self.scale = scale
+        self.image_base = image_base
+        self.image_dir = image_dir
+
+    def rng(self, name):
+        return random.Random('%s-%s' % (self.seed, name))
+
+    def sentence(self, rng, words=12):
+        return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(words // 2, words))).capitalize() + '.'
+
+    def prose(self):
+        rng = self.rng('prose')
+        parts = []
+        for i in range(40 * self.scale):
+            if i % 10 == 0:
+                parts.append('<h%d>%s</h%d>' % (i % 3 + 1, self.sentence(rng, 6), i % 3 + 1))
+            parts.append('<p>%s</p>' % ' '.join(self.sentence(rng) for _ in range(rng.randint(2, 6))))
+        return ''.join(parts)
+
+    def nested_lists(self):
+        rng = self.rng('nested_lists')
+
+        def build(depth):
+            tag = 'ol' if depth % 2 else 'ul'
+            items = []
+            for _ in range(rng.randint(2, 4)):
+                item = self.sentence(rng, 6)
+                if depth < 6 and rng.random() < 0.5:
+                    item += build(depth + 1)
+                items.append('<li>%s</li>' % item)
+            return '<%s>%s</%s>' % (tag, ''.join(items), tag)
+        return ''.join(build(0) for _ in range(10 * self.scale))
+
+    def tables(self):
+        rng = self.rng('tables')
+
+        def table(rows, cols, nested):
+            out = ['<table>', '<tr>%s</tr>' % ''.join('<th>Col %d</th>' % c for c in range(cols))]
+            for _ in range(rows):
+                cells = []
+                for _ in range(cols):
+                    if nested and rng.random() < 0.1:
+                        cells.append('<td>%s</td>' % table(2, 2, False))
+                    else:
+                        cells.append('<td>%s</td>' % self.sentence(rng, 4))
+                out.append('<tr>%s</tr>' % ''.join(cells))
+            out.append('</table>')
+            return ''.join(out)
+        return table(100 * self.scale, 6, False) + ''.join(table(10, 4, True) for _ in range(5 * self.scale))
+
+    def spans(self):
+        rng = self.rng('spans')
+        parts = []
+        for _ in range(60 * self.scale):
+            runs = []
+            for _ in range(rng.randint(5, 15)):
+                text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+                style = 'color: %s' % rng.choice(COLORS)
+                if rng.random() < 0.3:
+                    style += '; background-color: %s' % rng.choice(COLORS)
+                tag = rng.choice(('b', 'i', 'u', 'em', 'strong', 'code'))
+                runs.append('<span style="%s"><%s>%s</%s></span> ' % (style, tag, text, tag))
+            parts.append('<p style="text-align: %s">%s</p>' % (rng.choice(('left', 'center', 'right')), ''.join(runs)))
+        return ''.join(parts)
+
+    def links(self):
+        rng = self.rng('links')
+        parts = []
+        for i in range(60 * self.scale):
+            links = ' '.join(
+                '<a href="https://example.com/%d/%d">%s</a>' % (i, j, rng.choice(WORDS))
+                for j in range(rng.randint(3, 8))
+            )
+            parts.append('<p>%s %s</p>' % (self.sentence(rng, 6), links))
+        return ''.join(parts)
+
+    def images(self):
+        rng = self.rng('images')
+        inline = base64.b64encode(png(8, 8, (10, 120, 200))).decode('ascii')
+        parts = []
+        for i in range(20 * self.scale):
+            srcs = ['data:image/png;base64,' + inline]
+            if self.image_base:
+                # a handful of distinct remote images, each used many times
+                srcs.append('%s/img%d.png' % (self.image_base, i % 5))
+            if self.image_dir:
+                srcs.append(os.path.join(self.image_dir, 'local%d.png' % (i % 3)))
+            imgs = ''.join('<img src="%s" width="32" height="32">' % src for src in srcs)
+            parts.append('<p>%s %s</p>' % (self.sentence(rng, 8), imgs))
+        return ''.join(parts)
+
+    def data_images(self):
+        # editor exports: many distinct inline images, some repeated
+        rng = self.rng('data_images')
+        payloads = [
+            'data:image/png;base64,' + base64.b64encode(png(48, 48, (i % 256, 80, 255 - i % 256))).decode('ascii')
+            for i in range(200 * self.scale)
+        ]
+        parts = []
+        for i in range(300 * self.scale):
+            src = payloads[i] if i < len(payloads) else rng.choice(payloads)
+            parts.append('<p>%s</p><img src="%s">' % (self.sentence(rng, 6), src))
+        return ''.join(parts)
+
+    def cases(self):
+        return {
+            'prose': self.prose,
+            'nested_lists': self.nested_lists,
+            'tables': self.tables,
+            'spans': self.spans,
+            'links': self.links,
+            'images': self.images,
+            'data_images': self.data_images,
+        }
+
+    def write_local_images(self):
+        for i in range(3):
+            with open(os.path.join(self.image_dir, 'local%d.png' % i), 'wb') as f:
+                f.write(png(24, 24, (i * 80, 60, 200 - i * 60)))
+
+
+class ImageServer:
+    # Local stand-in for remote image hosts so the suite runs offline.
+
+    def __init__(self, count=5):
+        self.images = {'/img%d.png' % i: png(32, 32, (40 * i, 200 - 30 * i, 90)) for i in range(count)}
+        self.requests = 0
+        images, server = self.images, self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.requests += 1
+                body = images.get(self.path)
+                if body is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.base = 'http://127.0.0.1:%d' % self.httpd.server_port
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class PhaseTimer:
+    # Wraps the converter's top-level steps on one parser instance.
+    # parse is whatever run_process spends outside images and build
+    # (BeautifulSoup and the feed engine's tokenizing).
+
+    def __init__(self, parser):
+        self.phases = {'process': 0.0, 'images': 0.0, 'build': 0.0, 'save': 0.0}
+        self.depth = dict.fromkeys(self.phases, 0)
+        for name, phase in (('run_process', 'process'), ('prefetch_images', 'images'),
+                            ('walk_nodes', 'build'), ('save', 'save')):
+            setattr(parser, name, self.timed(getattr(parser, name), phase))
+
+    def timed(self, method, phase):
+        def wrapper(*args, **kwargs):
+            # walk_nodes re-enters for table cells; only the outermost call counts
+            self.depth[phase] += 1
+            started = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.depth[phase] -= 1
+                if self.depth[phase] == 0:
+                    self.phases[phase] += time.perf_counter() - started
+        return wrapper
+
+    def result(self):
+        phases = dict(self.phases)
+        process = phases.pop('process')
+        phases['parse'] = max(0.0, process - phases['images'] - phases['build'])
+        return phases
+
+
+def reset_caches():
+    htmldocx.image_cache.clear()
+    htmldocx.fetcher.cache.clear()
+
+
+def run_target(target, html, workdir, options=None):
+    # Returns (phases, output bytes). The document for add_html_to_document
+    # is created outside the timed region and saved afterwards for its size.
+    parser = HtmlToDocx()
+    parser.options.update(options or {})
+    timer = PhaseTimer(parser)
+    if target == 'parse_html_string':
+        out = os.path.join(workdir, 'string.docx')
+        parser.parse_html_string(html, out)
+    elif target == 'parse_html_file':
+        source = os.path.join(workdir, 'input.html')
+        with open(source, 'w') as f:
+            f.write(html)
+        parser.parse_html_file(source, os.path.join(workdir, 'file'))
+        out = os.path.join(workdir, 'file.docx')
+    elif target == 'add_html_to_document':
+        document = template_cache.new_document()
+        parser.add_html_to_document(html, document)
+        out = os.path.join(workdir, 'document.docx')
+        phases = timer.result()
+        document.save(out)
+        return phases, os.path.getsize(out)
+    else:
+        raise ValueError('Unknown target %s' % target)
+    return timer.result(), os.path.getsize(out)
+
+
+def bench_case(name, html, target, repeat, workdir, warm=False, options=None):
+    input_bytes = len(html.encode('utf-8'))
+    elements = len(BeautifulSoup(html, 'html.parser').find_all(True))
+    timings, runs = [], []
+    run_target(target, html, workdir, options)  # imports, template and style caches
+    for _ in range(repeat):
+        if not warm:
+            reset_caches()
+        started = time.perf_counter()
+        phases, output_bytes = run_target(target, html, workdir, options)
+        timings.append(time.perf_counter() - started)
+        runs.append(phases)
+    # peak memory is taken on a separate run; tracemalloc skews timings
+    if not warm:
+        reset_caches()
+    tracemalloc.start()
+    try:
+        run_target(target, html, workdir, options)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    best = min(timings)
+    return {
+        'case': name,
+        'target': target,
+        'input_bytes': input_bytes,
+        'elements': elements,
+        'seconds': {'min': best, 'median': statistics.median(timings), 'max': max(timings)},
+        'kb_per_s': input_bytes / 1024 / best if best else 0.0,
+        'elements_per_s': elements / best if best else 0.0,
+        'phases': {phase: min(run[phase] for run in runs) for phase in runs[0]},
+        'peak_memory_bytes': peak,
+        'output_bytes': output_bytes,
+    }
+
+
+def bench_cold_start(name, repeat):
+    code = 'import time\n' + COLD_START_CASES[name] + 'print(time.perf_counter() - started)\n'
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    timings = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', code], cwd=script_dir, check=True, capture_output=True, text=True,
+        ).stdout
+        timings.append(float(output.split()[-1]))
+    return {
+        'case': name,
+        'target': 'cold_start',
+        'seconds': {'min': min(timings), 'median': statistics.median(timings), 'max': max(timings)},
+    }
+
+
+def compare(previous, current):
+    # prints min-time ratios current/previous; > 1 is slower
+    before = {(r['case'], r['target']): r for r in previous['results']}
+    for r in current['results']:
+        old = before.get((r['case'], r['target']))
+        if old:
+            ratio = r['seconds']['min'] / old['seconds']['min'] if old['seconds']['min'] else 0.0
+            print('%-14s %-22s %7.3fs -> %7.3fs  x%.2f' % (
+                r['case'], r['target'], old['seconds']['min'], r['seconds']['min'], ratio))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='bench', description='Benchmark HtmlToDocx on a synthetic corpus')
+    parser.add_argument('-o', '--output', help='write results as JSON here')
+    parser.add_argument('--compare', help='JSON from an earlier run to compare against')
+    parser.add_argument('--scale', type=int, default=DEFAULT_SCALE, help='corpus size multiplier')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('-n', '--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--cases', nargs='+', help='subset of cases to run')
+    parser.add_argument('--targets', nargs='+', choices=TARGETS, default=list(TARGETS))
+    parser.add_argument('--warm', action='store_true', help='keep image caches between runs')
+    parser.add_argument('--writer', choices=('docx', 'fast'), default='docx')
+    parser.add_argument('--compress-level', type=int, default=htmldocx.DEFAULT_COMPRESS_LEVEL)
+    parser.add_argument('--store-images', action='store_true')
+    parser.add_argument('--cold-start', action='store_true',
+                        help='time imports and first conversions in fresh processes instead of the corpus')
+    args = parser.parse_args(argv)
+    options = {
+        'writer': args.writer,
+        'compress-level': args.compress_level,
+        'store-images': args.store_images,
+    }
+
+    results = []
+    if args.cold_start:
+        for name in args.cases or COLD_START_CASES:
+            if name not in COLD_START_CASES:
+                raise ValueError('Unknown case %s' % name)
+            result = bench_cold_start(name, args.repeat)
+            results.append(result)
+            print('%-22s %7.3fs min %7.3fs median' % (name, result['seconds']['min'], result['seconds']['median']))
+        return write_report(args, options, results)
+
+    workdir = tempfile.mkdtemp(prefix='htmldocx-bench-')
+    try:
+        with ImageServer() as server:
+            corpus = Corpus(args.seed, args.scale, image_base=server.base, image_dir=workdir)
+            corpus.write_local_images()
+            cases = corpus.cases()
+            for name in args.cases or cases:
+                if name not in cases:
+                    raise ValueError('Unknown case %s' % name)
+                html = cases[name]()
+                for target in args.targets:
+                    result = bench_case(name, html, target, args.repeat, workdir, args.warm, options)
+                    results.append(result)
+                    print('%-14s %-22s %7.3fs %9.1f KB/s %10.0f el/s %8.1f MB peak %8d B out' % (
+                        name, target, result['seconds']['min'], result['kb_per_s'],
+                        result['elements_per_s'], result['peak_memory_bytes'] / 1024 / 1024,
+                        result['output_bytes']))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return write_report(args, options, results)
+
+
+def write_report(args, options, results):
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'seed': args.seed,
+            'scale': args.scale,
+            'repeat': args.repeat,
+            'warm': args.warm,
+            'cold_start': args.cold_start,
+            'options': options,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
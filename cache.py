@@ -0,0 +1,266 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+DEFAULT_IMAGE_CACHE_BYTES = 32 * 1024 * 1024
+DEFAULT_RESULT_CACHE_BYTES = 64 * 1024 * 1024
+DEFAULT_FRAGMENT_CACHE_BYTES = 32 * 1024 * 1024
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class LRUCache:
+
+    def __init__(self, max_bytes, sizeof=len, on_evict=None):
+        # on_evict(key) runs for each evicted entry, outside the lock
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.on_evict = on_evict
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        evicted_keys = []
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= self.sizeof(old)
+            self._entries[key] = value
+            self.size += size
+            while self.size > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self.size -= self.sizeof(evicted)
+                self.evictions += 1
+                evicted_keys.append(evicted_key)
+        if self.on_evict is not None:
+            for evicted_key in evicted_keys:
+                self.on_evict(evicted_key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+        }
+
+
+class DiskStore:
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.path, key[-2:], key)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write-then-rename so concurrent readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            os.replace(tmp, path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+class ImageCache:
+    # Image bytes are stored once per content hash; URLs only point at a
+    # hash, so the same logo served from several URLs costs one entry.
+    # The URLs of a hash are forgotten when its bytes are evicted.
+
+    def __init__(self, max_bytes=DEFAULT_IMAGE_CACHE_BYTES, path=None):
+        self.memory = LRUCache(max_bytes, on_evict=self._evicted)
+        self.disk = DiskStore(path) if path else None
+        self.urls = {}
+        # digest -> URLs pointing at it
+        self.digest_urls = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def url_key(self, url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def get(self, url):
+        digest = self.urls.get(url)
+        data = self.memory.get(digest) if digest else None
+        from_disk = False
+        if data is None and self.disk:
+            digest = digest or self._disk_digest(url)
+            data = self.disk.get('blob-' + digest) if digest else None
+            if data is not None:
+                self.memory.put(digest, data)
+                from_disk = True
+        with self._lock:
+            if data is None:
+                self._unlink(url)
+                self.misses += 1
+            else:
+                self._link(url, digest)
+                if from_disk:
+                    self.disk_hits += 1
+                else:
+                    self.hits += 1
+        return data
+
+    def _disk_digest(self, url):
+        ref = self.disk.get('url-' + self.url_key(url))
+        return ref.decode('ascii') if ref else None
+
+    def _link(self, url, digest):
+        old = self.urls.get(url)
+        if old == digest:
+            return
+        if old is not None:
+            self._unlink(url)
+        self.urls[url] = digest
+        self.digest_urls.setdefault(digest, set()).add(url)
+
+    def _unlink(self, url):
+        digest = self.urls.pop(url, None)
+        urls = self.digest_urls.get(digest)
+        if urls is not None:
+            urls.discard(url)
+            if not urls:
+                del self.digest_urls[digest]
+
+    def _evicted(self, digest):
+        with self._lock:
+            for url in self.digest_urls.pop(digest, ()):
+                del self.urls[url]
+
+    def put(self, url, data):
+        digest = content_hash(data)
+        if digest not in self.memory:
+            self.memory.put(digest, data)
+        with self._lock:
+            if digest in self.memory or self.disk:
+                self._link(url, digest)
+            else:
+                # larger than the whole memory budget
+                self._unlink(url)
+        if self.disk:
+            self.disk.put('url-' + self.url_key(url), digest.encode('ascii'))
+            self.disk.put('blob-' + digest, data)
+        return digest
+
+    def clear(self):
+        self.memory.clear()
+        with self._lock:
+            self.urls.clear()
+            self.digest_urls.clear()
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            'urls': len(self.urls),
+            'memory': self.memory.stats(),
+        }
+
+
+class ResultCache:
+    # Finished documents keyed by a hash of the input and the converter
+    # settings; memory first, then the optional disk tier.
+
+    def __init__(self, max_bytes=DEFAULT_RESULT_CACHE_BYTES, path=None):
+        self.memory = LRUCache(max_bytes)
+        self.disk = DiskStore(path) if path else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        data = self.memory.get(key)
+        from_disk = False
+        if data is None and self.disk:
+            data = self.disk.get('result-' + key)
+            if data is not None:
+                self.memory.put(key, data)
+                from_disk = True
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            elif from_disk:
+                self.disk_hits += 1
+            else:
+                self.hits += 1
+        return data
+
+    def put(self, key, data):
+        self.memory.put(key, data)
+        if self.disk:
+            self.disk.put('result-' + key, data)
+
+    def clear(self):
+        self.memory.clear()
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            'memory': self.memory.stats(),
+        }
+
+
+def new_fragment_cache(max_bytes=DEFAULT_FRAGMENT_CACHE_BYTES):
+    # converted blocks (htmldocx.Fragment), weighed by their size
+    return LRUCache(max_bytes, sizeof=lambda fragment: fragment.size)
+
+
+image_cache = ImageCache()
@@ -0,0 +1,71 @@
+import copy
+
+from lxml import etree
+
+from docx.document import Document
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+from docx.text.paragraph import Paragraph
+from docx.text.run import Run
+
+
+W_P = qn('w:p')
+W_R = qn('w:r')
+W_SECTPR = qn('w:sectPr')
+
+
+class FastWriter:
+    # Builds w:p/w:r elements directly instead of going through python-docx's
+    # add_paragraph/add_run and property setters. Formatting is worked out
+    # once per key on a scratch element with the regular python-docx calls,
+    # so the pPr/rPr copied into each new element is exactly what the
+    # object layer would have produced. One writer serves one document.
+
+    def __init__(self):
+        self.ppr_templates = {}
+        self.rpr_templates = {}
+
+    def add_paragraph(self, container, key=None, build=None):
+        # container is a Document or a table cell; build(paragraph) applies
+        # the formatting named by key to a fresh paragraph
+        if isinstance(container, Document):
+            parent = container._body
+        else:
+            parent = container
+        if key is None:
+            template = None
+        elif key in self.ppr_templates:
+            template = self.ppr_templates[key]
+        else:
+            scratch = Paragraph(OxmlElement('w:p'), parent)
+            build(scratch)
+            template = scratch._p.pPr
+            self.ppr_templates[key] = template
+        element = parent._element
+        p = element.makeelement(W_P)
+        if template is not None:
+            p.append(copy.deepcopy(template))
+        # the body keeps its section properties last; len() of an lxml
+        # element walks all its children, element[-1] does not
+        try:
+            last = element[-1]
+        except IndexError:
+            last = None
+        if last is not None and last.tag == W_SECTPR:
+            last.addprevious(p)
+        else:
+            element.append(p)
+        return Paragraph(p, parent)
+
+    def add_run(self, paragraph, run_format):
+        # run_format is a hashable formatting value with apply_to_run(run)
+        try:
+            template = self.rpr_templates[run_format]
+        except KeyError:
+            scratch = Run(OxmlElement('w:r'), None)
+            run_format.apply_to_run(scratch)
+            template = self.rpr_templates[run_format] = scratch._r.rPr
+        r = etree.SubElement(paragraph._p, W_R)
+        if template is not None:
+            r.append(copy.deepcopy(template))
+        return Run(r, paragraph)
@@ -3,26 +3,47 @@ from docx.shared import Pt
 from docx.shared import RGBColor
 from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
 from docx.enum.text import WD_ALIGN_PARAGRAPH
-import base64
+from docx.enum.style import WD_STYLE_TYPE
 import binascii
-import http
-import pathlib
-import re, argparse
+import codecs
+import contextlib
+import copy
+import functools
+import glob
+import hashlib
+import re
 import io, os
+import json
+import sys
+import threading
 import time
-import urllib.request
-from typing import Optional, cast, Dict
-from urllib.parse import urlparse
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout, as_completed, wait
+from urllib.parse import unquote_to_bytes, urlparse
 from html.parser import HTMLParser
-from docx.oxml import OxmlElement
+from docx.oxml import OxmlElement, parse_xml
 
 import docx, docx.table
 from docx.image.exceptions import UnrecognizedImageError
 from docx.image.image import Image
 from docx.shared import RGBColor, Pt, Inches
 from docx.oxml.ns import qn
+from docx.oxml.shape import CT_Inline
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.opc.oxml import serialize_part_xml
+from docx.opc.packuri import PackURI
+from docx.opc.part import Part, XmlPart
+from docx.parts.image import ImagePart
 
-from bs4 import BeautifulSoup
+from lxml import etree
+
+from cache import LRUCache, content_hash, image_cache, new_fragment_cache
+from fastwriter import FastWriter
+from httpfetch import FetchError, fetcher
+from limits import BudgetExceeded, ConversionBudget
+from opcwriter import DEFAULT_COMPRESS_LEVEL, ChunkSink, deflate, save_package
+from stats import ConversionStats
 
 
 INDENT = 0.25
@@ -35,8 +56,206 @@ DEFAULT_TABLE_STYLE = None
 
 DEFAULT_PARAGRAPH_STYLE = None
 
-def add_watermark(doc, watermark_text, alignment=WD_PARAGRAPH_ALIGNMENT.CENTER):
-    watermark = doc.sections[0].footer.paragraphs[0]
+
+IMAGE_FETCH_WORKERS = 8
+IMAGE_FETCH_TIMEOUT = 10
+IMAGE_FETCH_DEADLINE = 30
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+# base64 characters decoded per step of a data: URI (a multiple of 4)
+DATA_URI_CHUNK_SIZE = 64 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
+STYLE_CACHE_SIZE = 1024
+# bump when a change alters the output, so disk-cached results go stale
+RESULT_CACHE_VERSION = 4
+# result cache entries for documents with remote or local images hold the
+# image sources behind this prefix; the document is stored under a key that
+# also covers the current bytes of those images
+IMAGE_MANIFEST = b'html2docx-images\n'
+PARALLEL_MIN_CHARS = 256 * 1024
+SECTION_CHUNKS_PER_WORKER = 4
+SECTION_START = re.compile(r'<(h1|h2|table)[\s/>]', re.I)
+RELATIONSHIP_ATTRS = (qn('r:id'), qn('r:embed'), qn('r:link'))
+W_RPR = qn('w:rPr')
+# touches the parser, the style registry, lists, tables, run formats and
+# hyperlinks without fetching anything
+WARMUP_HTML = (
+    '<h1>Title</h1><h2>Section</h2>'
+    '<p style="text-align:center;color:#333">Some <b>bold</b>, <i>italic</i> and '
+    '<span style="background-color:yellow">marked</span> text<br>with a '
+    '<a href="https://example.com/">link</a>.</p>'
+    '<ul><li>one</li><li>two<ol><li>nested</li></ol></li></ul>'
+    '<table><tr><th>a</th><th>b</th></tr><tr><td>1</td><td><code>2</code></td></tr></table>'
+    '<pre>pre\n  formatted</pre><blockquote>quote</blockquote><hr>'
+)
+
+
+class CopyOnWritePart:
+    # Mixed into the XML parts of a document cloned from a cached template.
+    # The parsed XML stays shared with the template until something
+    # touches _element; untouched parts save the template's bytes as-is.
+
+    def __init__(self, partname, content_type, source, blob, package):
+        Part.__init__(self, partname, content_type, package=package)
+        self._source = source
+        self._source_blob = blob
+        self._copy = None
+
+    @property
+    def _element(self):
+        if self._copy is None:
+            self._copy = copy.deepcopy(self._source)
+        return self._copy
+
+    @property
+    def blob(self):
+        if self._copy is None:
+            return self._source_blob
+        return serialize_part_xml(self._copy)
+
+
+copy_on_write_classes = {}
+
+
+def copy_on_write_class(cls):
+    if cls not in copy_on_write_classes:
+        copy_on_write_classes[cls] = type('CopyOnWrite' + cls.__name__, (CopyOnWritePart, cls), {})
+    return copy_on_write_classes[cls]
+
+
+class StyleRegistry:
+    # Style ids of one document's styles part, looked up by name once, so
+    # handlers write w:pStyle/w:tblStyle directly instead of searching
+    # styles.xml (through the part's relationships) for every element.
+    # The styles the converter picks itself (lists, headings) are resolved
+    # up front as well; as a custom template may lack some of them, a
+    # missing one only fails when an element needs it.
+
+    def __init__(self, part):
+        self.part = part
+        self.ids = {}
+        self.errors = {}
+        for name in builtin_paragraph_styles:
+            try:
+                self.resolve(name, WD_STYLE_TYPE.PARAGRAPH)
+            except ValueError:
+                pass
+
+    def resolve(self, name, style_type):
+        # the id to set, None for the type's default style (as python-docx
+        # does); ValueError when there is no such style of that type
+        if not isinstance(name, str):
+            # a style object, as python-docx accepts; cheap to check
+            return self.part.get_style_id(name, style_type)
+        key = (name, style_type)
+        if key in self.ids:
+            return self.ids[key]
+        if key in self.errors:
+            raise ValueError(f"Unable to apply style {name}.")
+        try:
+            style_id = self.part.get_style_id(name, style_type)
+        except (KeyError, ValueError) as e:
+            self.errors[key] = e
+            raise ValueError(f"Unable to apply style {name}.") from e
+        self.ids[key] = style_id
+        return style_id
+
+    def paragraph(self, name):
+        return self.resolve(name, WD_STYLE_TYPE.PARAGRAPH)
+
+    def table(self, name):
+        return self.resolve(name, WD_STYLE_TYPE.TABLE)
+
+
+def has_styles_part(part):
+    return any(rel.reltype == RT.STYLES for rel in part.rels.values())
+
+
+class Template:
+
+    def __init__(self, path=None):
+        document = Document(path)
+        self.package = document.part.package
+        # clones share the template's styles, so their ids are too; with
+        # no styles part each document has to look its styles up itself
+        self.styles = StyleRegistry(document.part) if has_styles_part(document.part) else None
+        self.parts = list(self.package.iter_parts())
+        self.blobs = {part: part.blob for part in self.parts}
+        # clones hand back these very blob objects until they are modified
+        self.blob_ids = {id(blob) for blob in self.blobs.values()}
+        self.deflated_blobs = {}
+
+    def clone_part(self, part, package):
+        if isinstance(part, XmlPart):
+            cls = copy_on_write_class(type(part))
+            return cls(part.partname, part.content_type, part._element, self.blobs[part], package)
+        if isinstance(part, ImagePart):
+            return ImagePart(part.partname, part.content_type, part.blob)
+        return type(part)(part.partname, part.content_type, part.blob, package)
+
+    def deflated(self, blob, level):
+        # the compressed form of an untouched template part is computed once
+        # per level and reused by every document saved from this template
+        if id(blob) not in self.blob_ids:
+            return None
+        key = (id(blob), level)
+        known = self.deflated_blobs.get(key)
+        if known is None:
+            known = self.deflated_blobs[key] = (zlib.crc32(blob), deflate(blob, level))
+        return known
+
+    def new_document(self):
+        package = type(self.package)()
+        clones = {part: self.clone_part(part, package) for part in self.parts}
+        for source, target in [(self.package, package)] + list(clones.items()):
+            for rel in source.rels.values():
+                related = rel.target_ref if rel.is_external else clones[rel.target_part]
+                target.rels.add_relationship(rel.reltype, related, rel.rId, rel.is_external)
+        package.after_unmarshal()
+        return package.main_document_part.document
+
+
+class TemplateCache:
+    # Base documents parsed once per (path, mtime); path None is
+    # python-docx's default template.
+
+    def __init__(self):
+        self.templates = {}
+        self._lock = threading.Lock()
+
+    def key(self, path):
+        if path is None:
+            return None
+        path = os.path.abspath(path)
+        return path, os.path.getmtime(path)
+
+    def get(self, path=None):
+        key = self.key(path)
+        template = self.templates.get(key)
+        if template is None:
+            template = Template(path)
+            with self._lock:
+                if key is not None:
+                    for old in [k for k in self.templates if k and k[0] == key[0]]:
+                        del self.templates[old]
+                self.templates[key] = template
+        return template
+
+    def new_document(self, path=None):
+        return self.get(path).new_document()
+
+
+template_cache = TemplateCache()
+
+def add_watermark(doc, watermark_text, alignment=WD_PARAGRAPH_ALIGNMENT.CENTER, section=None):
+    # Writes into the in-memory footer of section (the first one by
+    # default); further watermarks in the same footer get their own paragraph.
+    section = section or doc.sections[0]
+    footer = section.footer
+    if footer.is_linked_to_previous and section._sectPr is not doc.sections[0]._sectPr:
+        footer.is_linked_to_previous = False
+    watermark = footer.paragraphs[0] if footer.paragraphs else footer.add_paragraph()
+    if watermark.runs:
+        watermark = footer.add_paragraph()
     watermark.alignment = alignment
 
     run = watermark.add_run()
@@ -47,22 +266,90 @@ def add_watermark(doc, watermark_text, alignment=WD_PARAGRAPH_ALIGNMENT.CENTER):
 
     run.text = watermark_text
 
-    doc.save("output.docx")
+def add_bottom_border(paragraph):
+    pPr = paragraph._p.get_or_add_pPr()
+    pBdr = OxmlElement('w:pBdr')
+    pPr.insert_element_before(pBdr,
+        'w:shd', 'w:tabs', 'w:suppressAutoHyphens', 'w:kinsoku', 'w:wordWrap',
+        'w:overflowPunct', 'w:topLinePunct', 'w:autoSpaceDE', 'w:autoSpaceDN',
+        'w:bidi', 'w:adjustRightInd', 'w:snapToGrid', 'w:spacing', 'w:ind',
+        'w:contextualSpacing', 'w:mirrorIndents', 'w:suppressOverlap', 'w:jc',
+        'w:textDirection', 'w:textAlignment', 'w:textboxTightWrap',
+        'w:outlineLvl', 'w:divId', 'w:cnfStyle', 'w:rPr', 'w:sectPr',
+        'w:pPrChange'
+    )
+    bottom = OxmlElement('w:bottom')
+    bottom.set(qn('w:val'), 'single')
+    bottom.set(qn('w:sz'), '6')
+    bottom.set(qn('w:space'), '1')
+    bottom.set(qn('w:color'), 'auto')
+    pBdr.append(bottom)
 
 def get_filename_from_url(url):
     return os.path.basename(urlparse(url).path)
 
+def is_data_uri(src):
+    return src[:5].lower() == 'data:'
+
 def is_url(url):
+    if is_data_uri(url):
+        # urlparse would copy the whole payload for nothing
+        return False
     parts = urlparse(url)
     return all([parts.scheme, parts.netloc, parts.path])
 
-def fetch_image(url):
+def image_digest(data):
+    # same as python-docx's Image.sha1
+    return hashlib.sha1(data).hexdigest()
+
+def data_uri_type(uri):
+    # 'data:image/png', for placeholders
+    return uri[:256].split(',')[0].split(';')[0]
+
+def decode_data_uri(uri, max_bytes=MAX_IMAGE_BYTES):
+    # Decodes a data: URI into a stream one slice of the payload at a time,
+    # so the payload string is never copied whole. None if it is malformed
+    # or decodes to more than max_bytes.
+    comma = uri.find(',')
+    if comma < 0:
+        return None
+    if not uri[5:comma].lower().endswith(';base64'):
+        data = unquote_to_bytes(uri[comma + 1:])
+        return io.BytesIO(data) if 0 < len(data) <= max_bytes else None
+    if (len(uri) - comma - 1) // 4 * 3 > max_bytes + max_bytes // 2:
+        # even with generous line breaks this is over the limit
+        return None
+    image = io.BytesIO()
+    carry = b''
     try:
-        with urllib.request.urlopen(url) as response:
+        for start in range(comma + 1, len(uri), DATA_URI_CHUNK_SIZE):
+            piece = uri[start:start + DATA_URI_CHUNK_SIZE].encode('ascii')
+            chunk = carry + piece.translate(None, b' \t\r\n')
+            end = len(chunk) - len(chunk) % 4
+            carry = chunk[end:]
+            image.write(binascii.a2b_base64(chunk[:end]))
+            if image.tell() > max_bytes:
+                return None
+        if carry:
+            # browsers accept unpadded payloads
+            image.write(binascii.a2b_base64(carry + b'=' * (-len(carry) % 4)))
+    except (UnicodeEncodeError, binascii.Error):
+        return None
+    if not image.tell() or image.tell() > max_bytes:
+        return None
+    image.seek(0)
+    return image
 
-            return io.BytesIO(response.read())
-    except urllib.error.URLError:
+def fetch_image(url, timeout=IMAGE_FETCH_TIMEOUT, max_bytes=MAX_IMAGE_BYTES, deadline=None):
+    # Goes through the shared pooled fetcher; image bytes are cached by
+    # image_cache, so they are not kept again in its response cache.
+    try:
+        response = fetcher.fetch(url, timeout=timeout, max_bytes=max_bytes, deadline=deadline, cache=False)
+    except FetchError:
         return None
+    if response.status_code != 200:
+        return None
+    return io.BytesIO(response.content)
 
 def remove_last_occurence(ls, x):
     ls.pop(len(ls) - ls[::-1].index(x) - 1)
@@ -88,6 +375,159 @@ def delete_paragraph(paragraph):
     p.getparent().remove(p)
     p._p = p._element = None
 
+alignments = {
+    'center': WD_ALIGN_PARAGRAPH.CENTER,
+    'right': WD_ALIGN_PARAGRAPH.RIGHT,
+    'justify': WD_ALIGN_PARAGRAPH.JUSTIFY,
+}
+
+color_names = {
+    'black': (0, 0, 0),
+    'white': (255, 255, 255),
+    'red': (255, 0, 0),
+    'lime': (0, 255, 0),
+    'green': (0, 128, 0),
+    'blue': (0, 0, 255),
+    'yellow': (255, 255, 0),
+    'aqua': (0, 255, 255),
+    'cyan': (0, 255, 255),
+    'fuchsia': (255, 0, 255),
+    'magenta': (255, 0, 255),
+    'gray': (128, 128, 128),
+    'grey': (128, 128, 128),
+    'silver': (192, 192, 192),
+    'maroon': (128, 0, 0),
+    'olive': (128, 128, 0),
+    'navy': (0, 0, 128),
+    'purple': (128, 0, 128),
+    'teal': (0, 128, 128),
+    'orange': (255, 165, 0),
+}
+
+indent_units = {
+    'pt': 1 / 72,
+    'in': 1,
+    'cm': 1 / 2.54,
+    'mm': 1 / 25.4,
+    'em': 12 / 72,
+}
+
+def parse_style_string(string):
+    style = {}
+    for declaration in string.split(';'):
+        name, sep, value = declaration.partition(':')
+        if sep:
+            style[name.strip().lower()] = value.strip()
+    return style
+
+def parse_color(value):
+    value = value.strip().lower()
+    if value.startswith('#'):
+        digits = value[1:]
+        if len(digits) == 3:
+            digits = ''.join(c * 2 for c in digits)
+        try:
+            return tuple(int(digits[i:i+2], 16) for i in (0, 2, 4)) if len(digits) == 6 else None
+        except ValueError:
+            return None
+    if value.startswith('rgb'):
+        channels = re.findall(r'[\d.]+%?', value)[:3]
+        if len(channels) < 3:
+            return None
+        try:
+            return tuple(
+                min(255, round(float(c[:-1]) * 2.55 if c.endswith('%') else float(c)))
+                for c in channels
+            )
+        except ValueError:
+            return None
+    return color_names.get(value)
+
+def parse_indent(value):
+    match = re.match(r'^(-?[\d.]+)\s*([a-z]*)$', value.strip().lower())
+    if not match:
+        return None
+    try:
+        number = float(match.group(1))
+    except ValueError:
+        return None
+    unit = match.group(2)
+    if unit == 'px':
+        inches = number // 10 * INDENT
+    elif unit in indent_units:
+        inches = number * indent_units[unit]
+    elif not unit and number == 0:
+        inches = 0
+    else:
+        return None
+    return Inches(max(0, min(inches, MAX_INDENT)))
+
+def set_run_shading(run, fill):
+    rPr = run._r.get_or_add_rPr()
+    shd = rPr.find(qn('w:shd'))
+    if shd is None:
+        shd = OxmlElement('w:shd')
+        rPr.insert_element_before(shd,
+            'w:fitText', 'w:vertAlign', 'w:rtl', 'w:cs', 'w:em', 'w:lang',
+            'w:eastAsianLayout', 'w:specVanish', 'w:oMath'
+        )
+    shd.set(qn('w:val'), 'clear')
+    shd.set(qn('w:color'), 'auto')
+    shd.set(qn('w:fill'), fill)
+
+
+run_text_pattern = re.compile(r'([\t\r\n])')
+
+def append_run_text(r, text):
+    # Same content model as Run.text (tabs and line breaks become w:tab and
+    # w:br), but text landing after an existing w:t is appended to it.
+    for piece in run_text_pattern.split(text):
+        if not piece:
+            continue
+        if piece == '\t':
+            r.add_tab()
+        elif piece in '\r\n':
+            r.add_br()
+        elif len(r) and r[-1].tag == qn('w:t'):
+            t = r[-1]
+            t.text = t.text + piece
+            if len(t.text.strip()) < len(t.text):
+                t.set(qn('xml:space'), 'preserve')
+        else:
+            r.add_t(piece)
+
+
+class CompiledStyle(namedtuple('CompiledStyle', 'alignment left_indent color background')):
+    # An inline style attribute resolved to docx values. Immutable, so one
+    # instance is shared by every element carrying the same style string.
+    __slots__ = ()
+
+    def apply_to_paragraph(self, paragraph):
+        if self.alignment is not None:
+            paragraph.paragraph_format.alignment = self.alignment
+        if self.left_indent is not None:
+            paragraph.paragraph_format.left_indent = self.left_indent
+
+    def apply_to_run(self, run):
+        if self.color is not None:
+            run.font.color.rgb = self.color
+        if self.background is not None:
+            set_run_shading(run, self.background)
+
+
+@functools.lru_cache(maxsize=STYLE_CACHE_SIZE)
+def compile_style(string):
+    style = parse_style_string(string)
+    color = parse_color(style['color']) if 'color' in style else None
+    background = style.get('background-color') or style.get('background')
+    background = parse_color(background) if background else None
+    return CompiledStyle(
+        alignment=alignments.get(style.get('text-align', '').lower()),
+        left_indent=parse_indent(style['margin-left']) if 'margin-left' in style else None,
+        color=RGBColor(*color) if color else None,
+        background='%02X%02X%02X' % background if background else None,
+    )
+
 font_styles = {
     'b': 'bold',
     'strong': 'bold',
@@ -105,10 +545,302 @@ font_names = {
     'pre': 'Courier',
 }
 
+class RunFormat(namedtuple('RunFormat', 'flags font_name color background')):
+    # Effective character formatting at one point of the document. Each
+    # formatting tag derives a new RunFormat from the enclosing one.
+    __slots__ = ()
+
+    def derive(self, tag, style=None):
+        flags, font_name, color, background = self
+        if tag in font_styles:
+            flag = font_styles[tag]
+            if flag in ('superscript', 'subscript'):
+                flags = flags - {'superscript', 'subscript'}
+            flags = flags | {flag}
+        if tag in font_names:
+            font_name = font_names[tag]
+        if tag == 'a':
+            flags = flags | {'underline'}
+            color = LINK_COLOR
+        if style is not None:
+            if style.color is not None:
+                color = style.color
+            if style.background is not None:
+                background = style.background
+        return RunFormat(flags, font_name, color, background)
+
+    def apply_to_run(self, run):
+        if self.color is not None:
+            run.font.color.rgb = self.color
+        if self.background is not None:
+            set_run_shading(run, self.background)
+        for flag in self.flags:
+            setattr(run.font, flag, True)
+        if self.font_name:
+            run.font.name = self.font_name
+
+
+PLAIN = RunFormat(frozenset(), None, None, None)
+LINK_COLOR = RGBColor(0x00, 0x00, 0xEE)
+
 styles = {
     'LIST_BULLET': 'List Bullet',
     'LIST_NUMBER': 'List Number',
 }
+heading_styles = ['Heading %d' % level for level in range(1, 10)]
+builtin_paragraph_styles = list(styles.values()) + heading_styles
+
+void_tags = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+    'link', 'meta', 'param', 'source', 'track', 'wbr',
+}
+
+container_tags = {'html', 'body'}
+# layout wrappers that editors put around a whole document; outside a
+# block they are passed through like <html>/<body>, except watermark divs
+wrapper_tags = {'div', 'main', 'article', 'section'}
+
+
+def is_passthrough(tag, attrs):
+    if tag in container_tags:
+        return True
+    return tag in wrapper_tags and not (tag == 'div' and 'watermark' in (dict(attrs).get('id') or ''))
+
+
+@functools.lru_cache(maxsize=None)
+def metered_soup_class():
+    from bs4 import BeautifulSoup
+
+    class MeteredSoup(BeautifulSoup):
+        # charges each start tag to a budget meter as the tokenizer emits
+        # it, so a document over its limits stops while it is being parsed
+        def __init__(self, html, meter):
+            self.meter = meter
+            super().__init__(html, 'html.parser')
+
+        def handle_starttag(self, *args, **kwargs):
+            self.meter.scan()
+            return super().handle_starttag(*args, **kwargs)
+
+    return MeteredSoup
+
+
+def parse_html(html, meter=None):
+    # bs4 is only needed once a document is converted, not at import
+    if meter is not None:
+        return metered_soup_class()(html, meter)
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(html, 'html.parser')
+
+
+def iter_chunks(source, chunk_size=STREAM_CHUNK_SIZE):
+    if hasattr(source, 'read'):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        yield from source
+
+
+class BlockSplitter(HTMLParser):
+    # Tokenises a stream just far enough to cut it into top-level blocks.
+    # Each finished block is handed to on_block as HTML source, so only
+    # the block currently open is held in memory. <html>/<body> and
+    # wrapper elements are not blocks; their start and end tags are passed
+    # through as events, so a document wrapped in one <div> still splits.
+    # With a budget meter every start tag is charged to it as it is read.
+
+    def __init__(self, on_block, on_starttag, on_endtag, meter=None):
+        super().__init__(convert_charrefs=False)
+        self.on_block = on_block
+        self.on_starttag = on_starttag
+        self.on_endtag = on_endtag
+        self.meter = meter
+        self.open_tags = []
+        self.buffer = []
+
+    def flush(self):
+        if self.buffer:
+            block = ''.join(self.buffer)
+            self.buffer = []
+            self.on_block(block)
+
+    def handle_starttag(self, tag, attrs):
+        if self.meter is not None:
+            self.meter.scan()
+        if not self.open_tags:
+            self.flush()
+            if is_passthrough(tag, attrs):
+                self.on_starttag(tag, attrs)
+                return
+        self.buffer.append(self.get_starttag_text())
+        if tag in void_tags:
+            if not self.open_tags:
+                self.flush()
+        else:
+            self.open_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        if self.meter is not None:
+            self.meter.scan()
+        if not self.open_tags:
+            self.flush()
+            if is_passthrough(tag, attrs):
+                self.on_starttag(tag, attrs)
+                self.on_endtag(tag)
+                return
+        self.buffer.append(self.get_starttag_text())
+        if not self.open_tags:
+            self.flush()
+
+    def handle_endtag(self, tag):
+        if tag not in self.open_tags:
+            if not self.open_tags and (tag in container_tags or tag in wrapper_tags):
+                self.flush()
+                self.on_endtag(tag)
+            return
+        self.buffer.append('</%s>' % tag)
+        # an end tag also closes anything left open inside it
+        del self.open_tags[len(self.open_tags) - self.open_tags[::-1].index(tag) - 1:]
+        if not self.open_tags:
+            self.flush()
+
+    def handle_data(self, data):
+        self.buffer.append(data)
+
+    def handle_entityref(self, name):
+        self.buffer.append('&%s;' % name)
+
+    def handle_charref(self, name):
+        self.buffer.append('&#%s;' % name)
+
+    def handle_comment(self, data):
+        self.buffer.append('<!--%s-->' % data)
+
+    def close(self):
+        super().close()
+        self.open_tags = []
+        self.flush()
+
+NO_TIMER = contextlib.nullcontext()
+
+
+class HyperlinkIndex:
+    # href -> rId for the external hyperlinks of one part. Part.relate_to
+    # compares a new target with every relationship of the part and then
+    # probes rIds from rId1, so each link costs O(links); here both are
+    # dict lookups. rIds come out the same as relate_to would number them.
+
+    def __init__(self, part):
+        self.rels = part.rels
+        self.rids = {
+            rel.target_ref: rId for rId, rel in self.rels.items()
+            if rel.is_external and rel.reltype == RT.HYPERLINK
+        }
+        self.next_id = 1
+
+    def get(self, href):
+        rId = self.rids.get(href)
+        if rId is None:
+            # relationships are never removed, so ids below next_id stay taken
+            while 'rId%d' % self.next_id in self.rels:
+                self.next_id += 1
+            rId = 'rId%d' % self.next_id
+            self.rels.add_relationship(RT.HYPERLINK, href, rId, is_external=True)
+            self.rids[href] = rId
+        return rId
+
+
+class ImageIndex:
+    # Image parts by SHA1 and their rIds in one part. ImageParts compares a
+    # new image with every image part and numbers it by collecting all their
+    # partnames, and relate_to scans the part's relationships, so each new
+    # image costs O(images); here these are dict lookups. Partnames and
+    # rIds come out as python-docx would number them.
+
+    def __init__(self, part):
+        self.rels = part.rels
+        self.image_parts = part.package.image_parts
+        self.rids = {
+            rel.target_part: rId for rId, rel in self.rels.items()
+            if not rel.is_external and rel.reltype == RT.IMAGE
+        }
+        self.next_id = 1
+        self.index_parts()
+
+    def index_parts(self):
+        self.parts = {image_part.sha1: image_part for image_part in self.image_parts}
+        self.numbers = {image_part.partname.idx for image_part in self.image_parts}
+        self.next_number = 1
+        self.known_parts = len(self.image_parts)
+
+    def get(self, image_descriptor):
+        # (rId, Image), like StoryPart.get_or_add_image
+        if len(self.image_parts) != self.known_parts:
+            # another part of the package added images
+            self.index_parts()
+        image = Image.from_file(image_descriptor)
+        image_part = self.parts.get(image.sha1)
+        if image_part is None:
+            while self.next_number in self.numbers:
+                self.next_number += 1
+            partname = PackURI('/word/media/image%d.%s' % (self.next_number, image.ext))
+            image_part = ImagePart.from_image(image, partname)
+            self.image_parts.append(image_part)
+            self.parts[image.sha1] = image_part
+            self.numbers.add(self.next_number)
+            self.known_parts += 1
+        rId = self.rids.get(image_part)
+        if rId is None:
+            while 'rId%d' % self.next_id in self.rels:
+                self.next_id += 1
+            rId = 'rId%d' % self.next_id
+            self.rels.add_relationship(RT.IMAGE, image_part, rId)
+            self.rids[image_part] = rId
+        return rId, image_part.image
+
+
+def fill_empty_cells(element):
+    # a conversion cut short can leave cells without the w:p Word requires
+    for tc in element.iter(qn('w:tc')):
+        if tc.find(qn('w:p')) is None:
+            tc.add_p()
+
+
+class Fragment(namedtuple('Fragment', 'xml rels state size usage images', defaults=(None, None))):
+    # Body elements produced by one block, serialised so a fragment can be
+    # cached or sent between processes. rels maps each rId used in xml to
+    # (reltype, target, is_external); image targets are the image bytes.
+    # state is the parser state the block left behind (see export_fragment),
+    # usage the BudgetMeter.usage() of converting it, charged again on reuse,
+    # images the block's image_sources.
+    __slots__ = ()
+
+
+class ConversionResult:
+
+    def __init__(self, document, output=None, content=None, cached=False, stats=None,
+                 save_time=None, output_size=None, error=None):
+        self._document = document
+        self.output = output
+        self.content = content
+        self.cached = cached
+        self.stats = stats
+        self.save_time = save_time
+        self.output_size = output_size
+        # the BudgetExceeded a partial conversion stopped at
+        self.error = error
+        self.partial = error is not None
+
+    @property
+    def document(self):
+        # a result served from the cache only has bytes; load on demand
+        if self._document is None and self.content is not None:
+            self._document = Document(io.BytesIO(self.content))
+        return self._document
+
 
 class HtmlToDocx(HTMLParser):
 
@@ -119,6 +851,11 @@ class HtmlToDocx(HTMLParser):
             'images': True,
             'tables': True,
             'styles': True,
+            'engine': 'tree',
+            'merge-runs': True,
+            'writer': 'docx',
+            'compress-level': DEFAULT_COMPRESS_LEVEL,
+            'store-images': False,
         }
         self.table_row_selectors = [
             'table > tr',
@@ -128,6 +865,17 @@ class HtmlToDocx(HTMLParser):
         ]
         self.table_style = DEFAULT_TABLE_STYLE
         self.paragraph_style = DEFAULT_PARAGRAPH_STYLE
+        self.image_fetch_workers = IMAGE_FETCH_WORKERS
+        self.image_fetch_timeout = IMAGE_FETCH_TIMEOUT
+        self.image_fetch_deadline = IMAGE_FETCH_DEADLINE
+        self.max_image_bytes = MAX_IMAGE_BYTES
+        self.image_cache = image_cache
+        self.template = None
+        self.result_cache = None
+        self.fragment_cache = None
+        self.instrument = False
+        self.hooks = []
+        self.budget = None
 
     def set_initial_attrs(self, document=None):
         self.tags = {
@@ -136,81 +884,129 @@ class HtmlToDocx(HTMLParser):
         }
         if document:
             self.doc = document
+            self.style_registry = StyleRegistry(document.part)
         else:
-            self.doc = Document()
+            template = template_cache.get(self.template)
+            self.doc = template.new_document()
+            self.style_registry = template.styles or StyleRegistry(self.doc.part)
+        # configured styles must exist before anything is converted
+        if self.paragraph_style:
+            self.style_registry.paragraph(self.paragraph_style)
+        if self.table_style:
+            self.style_registry.table(self.table_style)
         self.bs = self.options['fix-html'] 
         self.document = self.doc
         self.include_tables = True 
         self.include_images = self.options['images']
         self.include_styles = self.options['styles']
         self.paragraph = None
+        self.run = None
+        self.run_format = None
+        self.run_formats = [(None, None, PLAIN)]
+        self.writer = FastWriter() if self.options['writer'] == 'fast' else None
+        self.stats = ConversionStats(self.hooks) if self.instrument else None
         self.skip = False
         self.skip_tag = None
         self.instances_to_skip = 0
+        self.current_node = None
+        self.table_no = 0
+        # one entry per open div, True for watermark divs; the text of open
+        # watermark divs is gathered in watermark_texts
+        self.div_stack = []
+        self.watermark_texts = []
+        # set when a block writes outside the body (watermark footers)
+        self.outside_body = False
+        self.watermarks = []
+        self.fetched_images = {}
+        self.images = {}
+        # src -> SHA1 of the bytes embedded for each remote or local image,
+        # None where an image fell back to a placeholder
+        self.image_sources = {}
+        self.data_images = set()
+        self.shape_ids = {}
+        self.hyperlinks = {}
+        self.image_indexes = {}
+        # the w:hyperlink the open <a> is writing into
+        self.hyperlink = None
+        self.meter = self.budget.meter() if self.budget is not None else None
+        self.budget_error = None
+
+    def timed(self, phase):
+        return self.stats.timer(phase) if self.stats is not None else NO_TIMER
+
+    @contextlib.contextmanager
+    def within_budget(self):
+        # A partial budget turns BudgetExceeded into an early end; the
+        # document keeps what was converted before the limit was hit.
+        try:
+            yield
+        except BudgetExceeded as e:
+            if self.meter is None or not self.meter.partial:
+                raise
+            self.budget_error = e
+            self.skip = False
+            fill_empty_cells(self.doc._element)
+            if self.stats is not None:
+                self.stats.add('partial_results')
 
     def copy_settings_from(self, other):
         
         self.table_style = other.table_style
         self.paragraph_style = other.paragraph_style
+        self.image_fetch_workers = other.image_fetch_workers
+        self.image_fetch_timeout = other.image_fetch_timeout
+        self.image_fetch_deadline = other.image_fetch_deadline
+        self.max_image_bytes = other.max_image_bytes
+        self.image_cache = other.image_cache
+        self.template = other.template
+        self.result_cache = other.result_cache
+        self.fragment_cache = other.fragment_cache
+        self.instrument = other.instrument
+        self.hooks = other.hooks
+        # a parser that is converting shares its running meter
+        meter = getattr(other, 'meter', None)
+        self.budget = meter if meter is not None else other.budget
 
     def get_cell_html(self, soup):
       
         return ' '.join([str(i) for i in soup.contents])
 
     def add_styles_to_paragraph(self, style):
-        if 'text-align' in style:
-            align = style['text-align']
-            if align == 'center':
-                self.paragraph.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.CENTER
-            elif align == 'right':
-                self.paragraph.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-            elif align == 'justify':
-                self.paragraph.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-        if 'margin-left' in style:
-            margin = style['margin-left']
-            units = re.sub(r'[0-9]+', '', margin)
-            margin = re.sub(r'[^\d\.]+', '', style["margin-left"])
-            if units == 'px':
-                self.paragraph.paragraph_format.left_indent = Inches(min(margin // 10 * INDENT, MAX_INDENT))
-          
+        style.apply_to_paragraph(self.paragraph)
 
     def add_styles_to_run(self, style):
-        if 'color' in style:
-            if 'rgb' in style['color']:
-                color = re.sub(r'[a-z()]+', '', style['color'])
-                colors = [int(x) for x in color.split(',')]
-            elif '#' in style['color']:
-                color = style['color'].lstrip('#')
-                colors = tuple(int(color[i:i+2], 16) for i in (0, 2, 4))
-            else:
-                colors = [0, 0, 0]
-              
-            self.run.font.color.rgb = RGBColor(*colors)
-            
-        if 'background-color' in style:
-            if 'rgb' in style['background-color']:
-                color = color = re.sub(r'[a-z()]+', '', style['background-color'])
-                colors = [int(x) for x in color.split(',')]
-            elif '#' in style['background-color']:
-                color = style['background-color'].lstrip('#')
-                colors = tuple(int(color[i:i+2], 16) for i in (0, 2, 4))
-            else:
-                colors = [0, 0, 0]
-                
-            self.run.font.highlight_color = WD_COLOR.GRAY_25 
-
-    def apply_paragraph_style(self, style=None):
-        try:
-            if style:
-                self.paragraph.style = style
-            elif self.paragraph_style:
-                self.paragraph.style = self.paragraph_style
-        except KeyError as e:
-            raise ValueError(f"Unable to apply style {self.paragraph_style}.") from e
+        style.apply_to_run(self.run)
+
+    def apply_paragraph_style(self, style=None, paragraph=None):
+        if paragraph is None:
+            paragraph = self.paragraph
+        style = style or self.paragraph_style
+        if style:
+            paragraph._p.style = self.style_registry.paragraph(style)
+
+    def new_paragraph(self, key=None, build=None):
+        # key names the formatting build(paragraph) applies; the fast writer
+        # runs build once per key and copies the resulting pPr afterwards
+        if self.writer is not None:
+            return self.writer.add_paragraph(self.doc, key, build)
+        paragraph = self.doc.add_paragraph()
+        if build is not None:
+            build(paragraph)
+        return paragraph
+
+    def new_body_paragraph(self):
+        return self.new_paragraph('body', lambda paragraph: self.apply_paragraph_style(paragraph=paragraph))
+
+    def new_run(self, run_format=PLAIN):
+        if self.writer is not None:
+            return self.writer.add_run(self.paragraph, run_format)
+        run = self.paragraph.add_run()
+        run_format.apply_to_run(run)
+        return run
 
     def parse_dict_string(self, string, separator=';'):
         new_string = string.replace(" ", '').split(separator)
-        string_dict = dict([x.split(':') for x in new_string if ':' in x])
+        string_dict = dict([x.split(':', 1) for x in new_string if ':' in x])
         return string_dict
 
     def handle_li(self):
@@ -226,15 +1022,56 @@ class HtmlToDocx(HTMLParser):
         else:
             list_style = styles['LIST_BULLET']
 
-        self.paragraph = self.doc.add_paragraph(style=list_style)            
-        self.paragraph.paragraph_format.left_indent = Inches(min(list_depth * LIST_INDENT, MAX_INDENT))
-        self.paragraph.paragraph_format.line_spacing = 1
+        def build(paragraph):
+            self.apply_paragraph_style(list_style, paragraph)
+            paragraph.paragraph_format.left_indent = Inches(min(list_depth * LIST_INDENT, MAX_INDENT))
+            paragraph.paragraph_format.line_spacing = 1
+        self.paragraph = self.new_paragraph(('li', list_style, list_depth), build)
 
     def add_image_to_cell(self, cell, image):
         paragraph = cell.add_paragraph()
         run = paragraph.add_run()
         run.add_picture(image)
 
+    def next_shape_id(self, part):
+        # part.next_id rescans the whole story for ids; count from it once
+        shape_id = self.shape_ids.get(part) or part.next_id
+        self.shape_ids[part] = shape_id + 1
+        return shape_id
+
+    def hyperlink_rid(self, part, href):
+        index = self.hyperlinks.get(part)
+        if index is None:
+            index = self.hyperlinks[part] = HyperlinkIndex(part)
+        return index.get(href)
+
+    def image_rid(self, part, image):
+        index = self.image_indexes.get(part)
+        if index is None:
+            index = self.image_indexes[part] = ImageIndex(part)
+        return index.get(image)
+
+    def add_picture(self, src, image):
+        # Every occurrence of src reuses the relationship and parsed image
+        # header of the first, so repeats share one image part. data: URIs
+        # come in as 'data:' and the hash of their content.
+        run = self.doc.add_paragraph().add_run()
+        part = run.part
+        key = (part, src)
+        if key not in self.images:
+            self.images[key] = self.image_rid(part, image)
+        rId, picture = self.images[key]
+        cx, cy = picture.scaled_dimensions()
+        inline = CT_Inline.new_pic_inline(self.next_shape_id(part), rId, picture.filename, cx, cy)
+        run._r.add_drawing(inline)
+        return picture
+
+    def add_image_sources(self, sources):
+        # a source that fell back to a placeholder anywhere stays None
+        for src, digest in sources.items():
+            if digest is None or src not in self.image_sources:
+                self.image_sources[src] = digest
+
     def handle_img(self, current_attrs):
         if not self.include_images:
             self.skip = True
@@ -243,40 +1080,131 @@ class HtmlToDocx(HTMLParser):
         if('src' not in current_attrs.keys()):
             return
         src = current_attrs['src']
+        if is_data_uri(src):
+            self.handle_data_image(src)
+            return
         # fetch image
         src_is_url = is_url(src)
         if src_is_url:
-            try:
-                image = fetch_image(src)
-            except urllib.error.URLError:
-                image = None
+            if src in self.fetched_images:
+                data = self.fetched_images[src]
+                image = io.BytesIO(data) if data else None
+            else:
+                image = fetch_image(src, self.image_fetch_timeout, self.max_image_bytes)
+                if image and self.stats is not None:
+                    self.stats.add('images_fetched')
+                    self.stats.add('bytes_fetched', len(image.getvalue()))
+                if image and self.meter is not None:
+                    self.meter.add('image_bytes', len(image.getvalue()))
         else:
             image = src
+            if self.meter is not None:
+                try:
+                    self.meter.add('image_bytes', os.path.getsize(src))
+                except OSError:
+                    pass
         if image:
             try:
-                if isinstance(self.doc, docx.document.Document):
-                    self.doc.add_picture(image)
-                else:
-                    self.add_image_to_cell(self.doc, image)
-            except FileNotFoundError:
+                picture = self.add_picture(src, image)
+            except (FileNotFoundError, UnrecognizedImageError):
                 image = None
+            else:
+                self.add_image_sources({src: picture.sha1})
         if not image:
+            self.image_sources[src] = None
             if src_is_url:
                 self.doc.add_paragraph("<image: %s>" % src)
             else:
                 self.doc.add_paragraph("<image: %s>" % get_filename_from_url(src))
 
+    def handle_data_image(self, src):
+        # Identical payloads hash to one key, so however often an editor
+        # repeats an inline image it is stored and measured once.
+        image = decode_data_uri(src, self.max_image_bytes)
+        if image is not None:
+            digest = 'data:' + content_hash(image.getbuffer())
+            if self.stats is not None:
+                self.stats.add('data_images')
+            if digest not in self.data_images:
+                self.data_images.add(digest)
+                if self.meter is not None:
+                    self.meter.add('image_bytes', image.getbuffer().nbytes)
+            try:
+                self.add_picture(digest, image)
+                return
+            except UnrecognizedImageError:
+                pass
+        self.doc.add_paragraph("<image: %s>" % data_uri_type(src))
+
+    def add_table(self, rows, cols):
+        if isinstance(self.doc, docx.document.Document):
+            # Document.add_table would look up its (None) style by name
+            self.table = self.doc._body.add_table(rows, cols, self.doc._block_width)
+        else:
+            self.table = self.doc.add_table(rows, cols)
+        if self.table_style:
+            self.table._tbl.tblStyle_val = self.style_registry.table(self.table_style)
+        return self.table
+
+    def prefetch_images(self, srcs):
+        # Downloads every remote image up front on a bounded pool; sources
+        # still pending at the overall deadline count as failed fetches.
+        urls = list(dict.fromkeys(src for src in srcs if is_url(src)))
+        self.fetched_images = dict.fromkeys(urls)
+        if self.image_cache is not None:
+            for url in urls:
+                self.fetched_images[url] = self.image_cache.get(url)
+            urls = [url for url in urls if self.fetched_images[url] is None]
+        if self.stats is not None:
+            self.stats.add('image_cache_hits', len(self.fetched_images) - len(urls))
+        if self.meter is not None:
+            self.meter.add('image_bytes', sum(len(data) for data in self.fetched_images.values() if data))
+        if not urls:
+            return
+        fetch_deadline = self.image_fetch_deadline
+        if self.meter is not None and self.meter.expires is not None:
+            fetch_deadline = min(fetch_deadline, self.meter.remaining())
+        deadline = time.monotonic() + fetch_deadline
+        pool = ThreadPoolExecutor(max_workers=min(self.image_fetch_workers, len(urls)))
+        futures = {
+            pool.submit(fetch_image, url, self.image_fetch_timeout, self.max_image_bytes, deadline): url
+            for url in urls
+        }
+        done, _ = wait(futures, timeout=fetch_deadline)
+        pool.shutdown(wait=False, cancel_futures=True)
+        for future in done:
+            image = future.result()
+            if image:
+                url = futures[future]
+                self.fetched_images[url] = image.getvalue()
+                if self.stats is not None:
+                    self.stats.add('images_fetched')
+                    self.stats.add('bytes_fetched', len(self.fetched_images[url]))
+                if self.image_cache is not None:
+                    self.image_cache.put(url, self.fetched_images[url])
+                if self.meter is not None:
+                    self.meter.add('image_bytes', len(self.fetched_images[url]))
+        if self.meter is not None:
+            self.meter.check_deadline()
+
     def handle_table(self):
      
-        table_soup = self.tables[self.table_no]
-        rows, cols = self.get_table_dimensions(table_soup)
-        self.table = self.doc.add_table(rows, cols)
+        with self.timed('tables'):
+            if self.current_node is not None:
+                self.build_table(self.current_node)
+                # the tree walker does not descend into skipped subtrees
+                self.instances_to_skip = 0
+            else:
+                self.handle_table_html(self.tables[self.table_no])
+        self.skip_tag = 'table'
+        self.skip = True
+        self.table = None
 
-        if self.table_style:
-            try:
-                self.table.style = self.table_style
-            except KeyError as e:
-                raise ValueError(f"Unable to apply style {self.table_style}.") from e
+    def handle_table_html(self, table_soup):
+        rows, cols = self.get_table_dimensions(table_soup)
+        if self.meter is not None:
+            self.meter.add('table_cells', rows * cols)
+        self.add_table(rows, cols)
 
         rows = self.get_table_rows(table_soup)
         cell_row = 0
@@ -291,55 +1219,112 @@ class HtmlToDocx(HTMLParser):
                 child_parser = HtmlToDocx()
                 child_parser.copy_settings_from(self)
                 child_parser.add_html_to_cell(cell_html, docx_cell)
+                if self.stats is not None:
+                    self.stats.add('table_cells')
+                    self.stats.merge(child_parser.stats)
                 cell_col += 1
             cell_row += 1
         
-     
         self.instances_to_skip = len(table_soup.find_all('table'))
-        self.skip_tag = 'table'
-        self.skip = True
-        self.table = None
-
-    def handle_link(self, href, text):
-    
-        is_external = href.startswith('http')
-        rel_id = self.paragraph.part.relate_to(
-            href,
-            docx.opc.constants.RELATIONSHIP_TYPE.HYPERLINK,
-            is_external=True  
-        )
-
-
-        hyperlink = docx.oxml.shared.OxmlElement('w:hyperlink')
-        hyperlink.set(docx.oxml.shared.qn('r:id'), rel_id)
-
-
-
-        subrun = self.paragraph.add_run()
-        rPr = docx.oxml.shared.OxmlElement('w:rPr')
-
-
-        c = docx.oxml.shared.OxmlElement('w:color')
-        c.set(docx.oxml.shared.qn('w:val'), "0000EE")
-        rPr.append(c)
-
-    
-        u = docx.oxml.shared.OxmlElement('w:u')
-        u.set(docx.oxml.shared.qn('w:val'), 'single')
-        rPr.append(u)
 
-        subrun._r.append(rPr)
-        subrun._r.text = text
+    def build_table(self, table_soup):
+        # Converts every cell from the parsed subtree with this parser,
+        # walking the new table's w:tr/w:tc elements once instead of
+        # looking each cell up through table.cell().
+        rows = self.get_table_rows(table_soup)
+        cols = self.get_table_columns(rows[0]) if rows else []
+        if self.meter is not None:
+            self.meter.add('table_cells', len(rows) * len(cols))
+        table = self.add_table(len(rows), len(cols))
 
-      
-        hyperlink.append(subrun._r)
+        saved = (
+            self.doc, self.document, self.tags, self.paragraph,
+            self.run, self.run_format, self.run_formats,
+        )
+        try:
+            for tr, row in zip(table._tbl.tr_lst, rows):
+                for tc, col in zip(tr.tc_lst, self.get_table_columns(row)):
+                    self.convert_cell(docx.table._Cell(tc, table), col)
+        finally:
+            (
+                self.doc, self.document, self.tags, self.paragraph,
+                self.run, self.run_format, self.run_formats,
+            ) = saved
+            self.table = table
+
+    def convert_cell(self, cell, cell_soup):
+        if self.stats is not None:
+            self.stats.add('table_cells')
+        delete_paragraph(cell.paragraphs[0])
+        self.doc = self.document = cell
+        self.tags = {
+            'span': [],
+            'list': [],
+        }
+        self.run_formats = [(None, None, PLAIN)]
+        if cell_soup.name == 'th':
+            self.tags['b'] = {}
+            self.push_run_format('b')
+        self.paragraph = None
+        self.run = None
+        self.run_format = None
+        self.walk_nodes(cell_soup.contents)
+        if not cell._tc.p_lst:
+            cell.add_paragraph('')
 
-  
-        self.paragraph._p.append(hyperlink)
+    def handle_link(self, href, text):
+        # All text of one <a> goes into a single w:hyperlink for as long as
+        # it stays in the same paragraph; its runs carry the link formatting
+        # on top of the surrounding one.
+        p = self.paragraph._p
+        hyperlink = self.hyperlink
+        if hyperlink is None or not len(p) or p[-1] is not hyperlink:
+            hyperlink = self.hyperlink = etree.SubElement(p, qn('w:hyperlink'))
+            hyperlink.set(qn('r:id'), self.hyperlink_rid(self.paragraph.part, href))
+        self.add_text(text, hyperlink)
+
+    def push_run_format(self, tag, style=None):
+        self.run_formats.append((tag, style, self.run_formats[-1][-1].derive(tag, style)))
+
+    def pop_run_format(self, tag):
+        # Drops the innermost entry for tag; entries opened after it (only
+        # with misnested tags) are re-derived without its formatting.
+        for i in range(len(self.run_formats) - 1, 0, -1):
+            if self.run_formats[i][0] == tag:
+                break
+        else:
+            return
+        later = self.run_formats[i + 1:]
+        del self.run_formats[i:]
+        for tag, style, _ in later:
+            self.push_run_format(tag, style)
+
+    def add_text(self, data, parent=None):
+        # parent is the paragraph's w:p, or a w:hyperlink at its end
+        run_format = self.run_formats[-1][-1]
+        if parent is None:
+            parent = self.paragraph._p
+        if (self.options['merge-runs'] and self.run is not None and run_format == self.run_format
+                and len(parent) and parent[-1] is self.run._r):
+            if self.stats is not None and len(self.run._r) and self.run._r[-1].tag != W_RPR:
+                # only text joining a run that already has some saves a run;
+                # p, li and pre open with an empty one
+                self.stats.add('runs_merged')
+            append_run_text(self.run._r, data)
+            return
+        self.run = self.new_run(run_format)
+        if parent is not self.paragraph._p:
+            parent.append(self.run._r)
+        append_run_text(self.run._r, data)
+        self.run_format = run_format
 
     def handle_starttag(self, tag, attrs):
         if self.skip:
             return
+        if self.meter is not None:
+            self.meter.element()
+        if self.stats is not None:
+            self.stats.count_tag(tag)
         if tag == 'head':
             self.skip = True
             self.skip_tag = tag
@@ -350,53 +1335,52 @@ class HtmlToDocx(HTMLParser):
 
         current_attrs = dict(attrs)
 
+        if tag == 'div':
+            is_watermark = 'watermark' in current_attrs.get('id', '')
+            self.div_stack.append(is_watermark)
+            if is_watermark:
+                self.watermark_texts.append([])
+
         if tag == 'span':
             self.tags['span'].append(current_attrs)
+            style = current_attrs.get('style')
+            self.push_run_format(tag, compile_style(style) if style else None)
             return
         elif tag == 'ol' or tag == 'ul':
             self.tags['list'].append(tag)
             return 
         elif tag == 'br':
+            if not self.paragraph:
+                self.paragraph = self.new_body_paragraph()
+            if self.run is None:
+                self.run = self.new_run()
+                self.run_format = PLAIN
             self.run.add_break()
             return
 
         self.tags[tag] = current_attrs
+        if tag in font_styles or tag in font_names:
+            self.push_run_format(tag)
+        elif tag == 'a':
+            self.hyperlink = None
+            # an <a> without href (a named anchor) is plain text
+            if current_attrs.get('href'):
+                self.push_run_format(tag)
         if tag in ['p', 'pre']:
-            self.paragraph = self.doc.add_paragraph()
-            self.apply_paragraph_style()
+            self.paragraph = self.new_body_paragraph()
 
         elif tag == 'li':
             self.handle_li()
 
         elif tag == "hr":
-
-           
-
-            self.paragraph = self.doc.add_paragraph()
-            pPr = self.paragraph._p.get_or_add_pPr()
-            pBdr = OxmlElement('w:pBdr')
-            pPr.insert_element_before(pBdr,
-                'w:shd', 'w:tabs', 'w:suppressAutoHyphens', 'w:kinsoku', 'w:wordWrap',
-                'w:overflowPunct', 'w:topLinePunct', 'w:autoSpaceDE', 'w:autoSpaceDN',
-                'w:bidi', 'w:adjustRightInd', 'w:snapToGrid', 'w:spacing', 'w:ind',
-                'w:contextualSpacing', 'w:mirrorIndents', 'w:suppressOverlap', 'w:jc',
-                'w:textDirection', 'w:textAlignment', 'w:textboxTightWrap',
-                'w:outlineLvl', 'w:divId', 'w:cnfStyle', 'w:rPr', 'w:sectPr',
-                'w:pPrChange'
-            )
-            bottom = OxmlElement('w:bottom')
-            bottom.set(qn('w:val'), 'single')
-            bottom.set(qn('w:sz'), '6')
-            bottom.set(qn('w:space'), '1')
-            bottom.set(qn('w:color'), 'auto')
-            pBdr.append(bottom)
+            self.paragraph = self.new_paragraph('hr', add_bottom_border)
 
         elif re.match('h[1-9]', tag):
             if isinstance(self.doc, docx.document.Document):
-                h_size = int(tag[1])
-                self.paragraph = self.doc.add_heading(level=min(h_size, 9))
+                style = 'Heading %d' % min(int(tag[1]), 9)
+                self.paragraph = self.new_paragraph(('heading', style), lambda paragraph: self.apply_paragraph_style(style, paragraph))
             else:
-                self.paragraph = self.doc.add_paragraph()
+                self.paragraph = self.new_paragraph()
 
         elif tag == 'img':
             self.handle_img(current_attrs)
@@ -408,14 +1392,14 @@ class HtmlToDocx(HTMLParser):
 
      
         if tag in ['p', 'li', 'pre']:
-            self.run = self.paragraph.add_run()
+            self.run = self.new_run()
+            self.run_format = PLAIN
 
        
         if not self.include_styles:
             return
         if 'style' in current_attrs and self.paragraph:
-            style = self.parse_dict_string(current_attrs['style'])
-            self.add_styles_to_paragraph(style)
+            self.add_styles_to_paragraph(compile_style(current_attrs['style']))
 
     def handle_endtag(self, tag):
         if self.skip:
@@ -433,7 +1417,11 @@ class HtmlToDocx(HTMLParser):
         if tag == 'span':
             if self.tags['span']:
                 self.tags['span'].pop()
+                self.pop_run_format(tag)
                 return
+        elif tag == 'div':
+            if self.div_stack and self.div_stack.pop():
+                self.handle_watermark(''.join(self.watermark_texts.pop()))
         elif tag == 'ol' or tag == 'ul':
             remove_last_occurence(self.tags['list'], tag)
             return
@@ -442,7 +1430,13 @@ class HtmlToDocx(HTMLParser):
             self.table = None
             self.doc = self.document
             self.paragraph = None
+            self.run = None
 
+        if tag in font_styles or tag in font_names:
+            self.pop_run_format(tag)
+        elif tag == 'a':
+            self.hyperlink = None
+            self.pop_run_format(tag)
         if tag in self.tags:
             self.tags.pop(tag)
         
@@ -450,6 +1444,8 @@ class HtmlToDocx(HTMLParser):
     def handle_data(self, data):
         if self.skip:
             return
+        for text in self.watermark_texts:
+            text.append(data)
 
      
         if 'pre' not in self.tags:
@@ -457,31 +1453,15 @@ class HtmlToDocx(HTMLParser):
             data = remove_whitespace(data, True, True)
 
         if not self.paragraph:
-            self.paragraph = self.doc.add_paragraph()
-            self.apply_paragraph_style()
+            self.paragraph = self.new_body_paragraph()
 
     
         link = self.tags.get('a')
-        if link:
-            self.handle_link(link['href'], data)
+        if link and link.get('href'):
+            with self.timed('links'):
+                self.handle_link(link['href'], data)
         else:
-            
-            self.run = self.paragraph.add_run(data)
-            spans = self.tags['span']
-            for span in spans:
-                if 'style' in span:
-                    style = self.parse_dict_string(span['style'])
-                    self.add_styles_to_run(style)
-
-
-            for tag in self.tags:
-                if tag in font_styles:
-                    font_style = font_styles[tag]
-                    setattr(self.run.font, font_style, True)
-
-                if tag in font_names:
-                    font_name = font_names[tag]
-                    self.run.font.name = font_name
+            self.add_text(data)
 
     def ignore_nested_tables(self, tables_soup):
         new_tables = []
@@ -496,7 +1476,9 @@ class HtmlToDocx(HTMLParser):
 
     def get_table_rows(self, table_soup):
         
-        return table_soup.select(', '.join(self.table_row_selectors), recursive=False)
+        rows = table_soup.select(', '.join(self.table_row_selectors))
+        # the selectors also match rows of tables nested inside cells
+        return [row for row in rows if row.find_parent('table') is table_soup]
 
     def get_table_columns(self, row):
     
@@ -510,21 +1492,373 @@ class HtmlToDocx(HTMLParser):
         return len(rows), len(cols)
 
     def get_tables(self):
-        if not hasattr(self, 'soup'):
+        if getattr(self, 'soup', None) is None:
             self.include_tables = False
             return
          
         self.tables = self.ignore_nested_tables(self.soup.find_all('table'))  
         self.table_no = 0
 
-    def run_process(self, html):
-        if self.bs and BeautifulSoup:
-            self.soup = BeautifulSoup(html, 'html.parser')
+    def tree_attrs(self, node):
+        return [(k, ' '.join(v) if isinstance(v, list) else v) for k, v in node.attrs.items()]
+
+    def walk_nodes(self, nodes):
+        # Replays the parser events HTMLParser.feed would produce for
+        # str(soup), without serialising and re-tokenising the tree.
+        from bs4.element import PreformattedString, Tag
+        stack = [(None, iter(nodes))]
+        while stack:
+            parent, children = stack[-1]
+            node = next(children, None)
+            if node is None:
+                stack.pop()
+                if parent is not None:
+                    self.handle_endtag(parent.name)
+                continue
+            if isinstance(node, Tag):
+                self.current_node = node
+                self.handle_starttag(node.name, self.tree_attrs(node))
+                self.current_node = None
+                if self.skip or not node.contents:
+                    self.handle_endtag(node.name)
+                else:
+                    if self.meter is not None:
+                        self.meter.enter(len(stack))
+                    stack.append((node, iter(node.contents)))
+            elif not isinstance(node, PreformattedString):
+                self.handle_data(str(node))
+
+    def run_process(self, html, meter=None):
+        # meter, when given, is charged for the tags of html as it is parsed
+        if self.bs:
+            try:
+                with self.timed('parse'):
+                    self.soup = parse_html(html, meter)
+            except BudgetExceeded:
+                if meter is None or not meter.partial:
+                    raise
+                # a partial budget keeps what fits: convert block by block
+                # up to the limit instead of from the unfinished tree
+                splitter = BlockSplitter(self.convert_block, self.handle_starttag, self.handle_endtag)
+                splitter.feed(html)
+                splitter.close()
+                return
+            if self.include_images:
+                with self.timed('images'):
+                    self.prefetch_images(img['src'] for img in self.soup.find_all('img', src=True))
+            if self.options['engine'] == 'tree':
+                self.walk_nodes(self.soup.contents)
+                self.soup = None
+                return
             html = str(self.soup)
         if self.include_tables:
             self.get_tables()
         self.feed(html)
-        self.process_watermark_tags()
+
+    def convert_block(self, html):
+        with self.timed('parse'):
+            self.soup = parse_html(html)
+        if self.include_images:
+            with self.timed('images'):
+                self.prefetch_images(img['src'] for img in self.soup.find_all('img', src=True))
+        self.walk_nodes(self.soup.contents)
+        self.soup = None
+
+    def convert_stream(self, source, out, encoding='utf-8', chunk_size=STREAM_CHUNK_SIZE):
+        # source is a file object (binary or text) or an iterable of
+        # bytes/str chunks; out is a path or a writable binary stream.
+        self.set_initial_attrs()
+        with self.timed('total'):
+            with self.within_budget():
+                splitter = BlockSplitter(self.convert_block, self.handle_starttag, self.handle_endtag, self.meter)
+                decoder = codecs.getincrementaldecoder(encoding)('replace')
+                for chunk in iter_chunks(source, chunk_size):
+                    if isinstance(chunk, bytes):
+                        if self.meter is not None:
+                            self.meter.read(len(chunk))
+                        chunk = decoder.decode(chunk)
+                    elif self.meter is not None:
+                        self.meter.read(len(chunk.encode(encoding, 'replace')))
+                    splitter.feed(chunk)
+                splitter.feed(decoder.decode(b'', final=True))
+                splitter.close()
+            return self.save(out)
+
+    def body_length(self):
+        # body children before the trailing w:sectPr
+        body = self.doc.element.body
+        if len(body) and body[-1].tag == qn('w:sectPr'):
+            return len(body) - 1
+        return len(body)
+
+    def block_context(self):
+        # everything a top-level block's output depends on besides its own
+        # source; an open paragraph only matters if the block writes into
+        # it, and such blocks are never cached
+        return repr((
+            self.paragraph is not None,
+            sorted(self.tags.items()),
+            [(tag, style) for tag, style, _ in self.run_formats],
+            self.skip, self.skip_tag, self.instances_to_skip,
+            len(self.div_stack),
+        ))
+
+    def export_fragment(self, start, open_p=None, with_state=True):
+        # Packs the body elements from index start onwards, with the rels
+        # they use and (with_state) the state needed to carry on after them.
+        # Returns None when that state or a relationship cannot be carried over.
+        body = self.doc.element.body
+        elements = list(body[start:self.body_length()])
+        part = self.doc.part
+        rels, size = {}, 0
+        for element in elements:
+            for node in element.iter():
+                for attr in RELATIONSHIP_ATTRS:
+                    rId = node.get(attr)
+                    if rId is None or rId in rels:
+                        continue
+                    rel = part.rels[rId]
+                    if rel.is_external:
+                        rels[rId] = (rel.reltype, rel.target_ref, True)
+                    elif rel.reltype == RT.IMAGE:
+                        rels[rId] = (rel.reltype, rel.target_part.blob, False)
+                        size += len(rels[rId][1])
+                    else:
+                        return None
+        xml = [etree.tostring(element) for element in elements]
+        size = size + sum(len(x) for x in xml)
+        if not with_state:
+            return Fragment(xml, rels, None, size)
+        if self.paragraph is None:
+            paragraph = None
+        elif self.paragraph._p is open_p:
+            paragraph = 'open'
+        elif self.paragraph._p.getparent() is body and self.paragraph._p in elements:
+            paragraph = elements.index(self.paragraph._p)
+        else:
+            return None
+        run = None
+        if self.run is not None:
+            # the run's index in the paragraph, or (hyperlink, run) indexes
+            parent = self.run._r.getparent() if self.paragraph is not None else None
+            if parent is None:
+                return None
+            elif parent is self.paragraph._p:
+                run = parent.index(self.run._r)
+            elif parent.getparent() is self.paragraph._p:
+                run = (self.paragraph._p.index(parent), parent.index(self.run._r))
+            else:
+                return None
+        state = (
+            paragraph, run, self.run_format,
+            copy.deepcopy(self.tags), list(self.run_formats),
+            self.skip, self.skip_tag, self.instances_to_skip,
+        )
+        return Fragment(xml, rels, state, size)
+
+    def import_fragment(self, fragment):
+        # Appends a fragment to this document: its relationships are added
+        # to this part (images by content, so repeats share one part), rIds
+        # and drawing ids are rewritten, and the saved state is restored.
+        part = self.doc.part
+        rids = {}
+        for rId, (reltype, target, is_external) in fragment.rels.items():
+            if is_external and reltype == RT.HYPERLINK:
+                rids[rId] = self.hyperlink_rid(part, target)
+            elif is_external:
+                rids[rId] = part.relate_to(target, reltype, is_external=True)
+            else:
+                rids[rId] = self.image_rid(part, io.BytesIO(target))[0]
+        body = self.doc.element.body
+        sectPr = body[-1] if len(body) and body[-1].tag == qn('w:sectPr') else None
+        elements = []
+        for xml in fragment.xml:
+            element = parse_xml(xml)
+            if rids:
+                for node in element.iter():
+                    for attr in RELATIONSHIP_ATTRS:
+                        rId = node.get(attr)
+                        if rId is not None:
+                            node.set(attr, rids[rId])
+            for doc_pr in element.iter(qn('wp:docPr')):
+                shape_id = self.next_shape_id(part)
+                doc_pr.set('id', str(shape_id))
+                doc_pr.set('name', 'Picture %d' % shape_id)
+            if sectPr is not None:
+                sectPr.addprevious(element)
+            else:
+                body.append(element)
+            elements.append(element)
+
+        if fragment.state is None:
+            return
+        paragraph, run, run_format, tags, run_formats, skip, skip_tag, instances_to_skip = fragment.state
+        if paragraph is None:
+            self.paragraph = None
+        elif paragraph != 'open':
+            self.paragraph = docx.text.paragraph.Paragraph(elements[paragraph], self.doc._body)
+        if run is None:
+            self.run = None
+        elif isinstance(run, tuple):
+            self.run = docx.text.run.Run(self.paragraph._p[run[0]][run[1]], self.paragraph)
+        else:
+            self.run = docx.text.run.Run(self.paragraph._p[run], self.paragraph)
+        self.hyperlink = None
+        self.run_format = run_format
+        self.tags = copy.deepcopy(tags)
+        self.run_formats = list(run_formats)
+        self.skip, self.skip_tag, self.instances_to_skip = skip, skip_tag, instances_to_skip
+
+    def convert_cached_block(self, html):
+        key = content_hash('\0'.join((self.fragment_settings, self.block_context(), html)).encode('utf-8', 'surrogatepass'))
+        fragment = self.fragment_cache.get(key)
+        if fragment is not None and fragment.images and not self.images_unchanged(fragment.images):
+            fragment = None
+        if fragment is not None:
+            if self.meter is not None and fragment.usage is not None:
+                self.meter.add_usage(fragment.usage)
+            self.import_fragment(fragment)
+            self.add_image_sources(fragment.images or {})
+            if self.stats is not None:
+                self.stats.add('blocks_reused')
+            return
+        start = self.body_length()
+        open_p = self.paragraph._p if self.paragraph is not None else None
+        before = etree.tostring(open_p) if open_p is not None else None
+        used = self.meter.usage() if self.meter is not None else None
+        self.outside_body = False
+        image_sources, self.image_sources = self.image_sources, {}
+        try:
+            self.convert_block(html)
+        finally:
+            image_sources, self.image_sources = self.image_sources, image_sources
+            self.add_image_sources(image_sources)
+        if self.stats is not None:
+            self.stats.add('blocks_converted')
+        if self.outside_body or (open_p is not None and etree.tostring(open_p) != before):
+            return
+        fragment = self.export_fragment(start, open_p)
+        if fragment is not None:
+            if used is not None:
+                fragment = fragment._replace(usage={k: v - used[k] for k, v in self.meter.usage().items()})
+            self.fragment_cache.put(key, fragment._replace(images=image_sources))
+
+    def convert_incremental(self, html, out=None):
+        # Like convert, but each top-level block's output is cached by its
+        # source and context, so re-converting an edited document only
+        # converts the blocks that changed. Keep the same parser (or share
+        # its fragment_cache) between calls.
+        if self.fragment_cache is None:
+            self.fragment_cache = new_fragment_cache()
+        key = self.cache_key(html) if self.result_cache is not None else None
+        result = self.cached_result(key, out)
+        if result is not None:
+            return result
+        self.set_initial_attrs()
+        self.fragment_settings = self.settings_signature()
+        with self.timed('total'):
+            with self.within_budget():
+                self.check_input(html)
+                self.convert_blocks(html, self.convert_cached_block)
+            return self.finish(key, out)
+
+    def check_input(self, html):
+        # the input_bytes limit, before any of html is parsed
+        if self.meter is not None and self.meter.budget.input_bytes is not None:
+            self.meter.read(len(html.encode('utf-8', 'surrogatepass')))
+
+    def convert_blocks(self, html, on_block=None):
+        splitter = BlockSplitter(on_block or self.convert_block, self.handle_starttag, self.handle_endtag, self.meter)
+        splitter.feed(html)
+        splitter.close()
+
+    def convert_parallel(self, html, out=None, workers=None, executor=None):
+        # Converts a large document on several processes. The input is cut
+        # at top-level h1/h2 headings and tables into about four chunks per
+        # worker. Each chunk becomes one body fragment, and the fragments are
+        # merged here in order (rels, media and drawing ids via
+        # import_fragment). Every worker uses the same template, so style ids
+        # match; lists use paragraph styles, not numbering instances. Small
+        # inputs, or inputs without section boundaries, use convert().
+        workers = workers or os.cpu_count() or 1
+        if len(html) < PARALLEL_MIN_CHARS or (workers < 2 and executor is None):
+            return self.convert(html, out)
+        if self.budget is not None and self.budget.input_bytes is not None:
+            # too big to split: convert() refuses it, or gives an empty
+            # partial result, before parsing
+            if len(html.encode('utf-8', 'surrogatepass')) > self.budget.input_bytes:
+                return self.convert(html, out)
+        chunks = split_sections(html, workers * SECTION_CHUNKS_PER_WORKER)
+        if len(chunks) < 2:
+            return self.convert(html, out)
+        key = self.cache_key(html) if self.result_cache is not None else None
+        result = self.cached_result(key, out)
+        if result is not None:
+            return result
+        self.set_initial_attrs()
+        settings = self.settings()
+        if self.meter is not None:
+            # workers get what is left; their usage is summed up here
+            settings['budget'] = self.meter.remaining_budget()
+        if executor is None:
+            # multiprocessing is only loaded by callers that split documents
+            from concurrent.futures import ProcessPoolExecutor
+            pool = ProcessPoolExecutor(max_workers=workers)
+        else:
+            pool = executor
+        futures = [pool.submit(convert_section, settings, chunk) for chunk in chunks]
+        try:
+            with self.timed('total'):
+                with self.within_budget():
+                    for chunk, future in zip(chunks, futures):
+                        try:
+                            timeout = self.meter.remaining() if self.meter is not None else None
+                            fragment, watermarks, stats, usage, images, error = future.result(timeout)
+                        except FutureTimeout:
+                            # the builtin TimeoutError only from Python 3.11 on
+                            self.meter.check_deadline()
+                            raise
+                        # every chunk starts a fresh paragraph or table
+                        self.paragraph = self.run = None
+                        if fragment is None:
+                            # relationships a fragment cannot carry; convert here
+                            self.convert_blocks(chunk)
+                        else:
+                            self.import_fragment(fragment)
+                            self.add_image_sources(images)
+                            for text in watermarks:
+                                add_watermark(self.doc, text, section=self.doc.sections[-1])
+                        if self.stats is not None and stats is not None:
+                            self.stats.merge(stats)
+                        if usage is not None and fragment is not None:
+                            self.meter.add_usage(usage)
+                        if error is not None:
+                            raise error
+                return self.finish(key, out)
+        finally:
+            for future in futures:
+                future.cancel()
+            if executor is None:
+                pool.shutdown()
+
+    def settings(self):
+        # the picklable part of the configuration, for worker processes
+        return {
+            'options': dict(self.options),
+            'table_style': self.table_style,
+            'paragraph_style': self.paragraph_style,
+            'template': self.template,
+            'instrument': self.instrument,
+            'budget': self.budget,
+        }
+
+    def apply_settings(self, settings):
+        self.options.update(settings['options'])
+        self.table_style = settings['table_style']
+        self.paragraph_style = settings['paragraph_style']
+        self.template = settings['template']
+        self.instrument = settings.get('instrument', False)
+        self.budget = settings.get('budget')
 
     def add_html_to_document(self, html, document):
         if not isinstance(html, str):
@@ -532,7 +1866,9 @@ class HtmlToDocx(HTMLParser):
         elif not isinstance(document, docx.document.Document) and not isinstance(document, docx.table._Cell):
             raise ValueError('Second argument needs to be a %s' % docx.document.Document)
         self.set_initial_attrs(document)
-        self.run_process(html)
+        with self.within_budget():
+            self.check_input(html)
+            self.run_process(html, self.meter)
 
     def add_html_to_cell(self, html, cell):
         if not isinstance(cell, docx.table._Cell):
@@ -545,39 +1881,354 @@ class HtmlToDocx(HTMLParser):
         
         if not self.doc.paragraphs:
             self.doc.add_paragraph('')  
-    def process_watermark_tags(self):
-        if not self.soup:
-            return
-        div_tags = self.soup.find_all('div')
-        for div_tag in div_tags:
-            if 'id' in div_tag.attrs:
-                ids = div_tag['id']
-                if 'watermark' in ids:
-                    watermark_text = div_tag.get_text()
-                    print(watermark_text)
-                    add_watermark(self.doc,watermark_text)
+    def handle_watermark(self, text):
+        # goes to the footer of the section being written; inside table
+        # cells self.doc is the cell, so go through its document part
+        document = self.doc.part.document
+        add_watermark(document, text, section=document.sections[-1])
+        self.watermarks.append(text)
+        self.outside_body = True
+        if self.stats is not None:
+            self.stats.add('watermarks')
 
     def parse_html_file(self, filename_html, filename_docx=None):
         with open(filename_html, 'r') as infile:
             html = infile.read()
-        self.set_initial_attrs()
-        self.run_process(html)
         if not filename_docx:
             path, filename = os.path.split(filename_html)
             filename_docx = '%s/new_docx_file_%s' % (path, filename)
-        self.doc.save('%s.docx' % filename_docx)
+        self.convert(html, '%s.docx' % filename_docx)
 
     def parse_html_string(self, html, filename_docx=None):
-        self.set_initial_attrs()
-        self.run_process(html)
-
         if not filename_docx:
             filename_docx = "static/output.docx"
 
-
-        if not os.path.exists(filename_docx):
-            with open(filename_docx, 'w'):
-                pass
-
-        self.doc.save(filename_docx)
+        self.convert(html, filename_docx)
         return filename_docx
+
+    def save(self, out):
+        # out is a path or a writable binary stream. compress-level 0 stores
+        # every member; store-images stores PNG/JPEG/GIF parts only.
+        with self.timed('save'):
+            started = time.perf_counter()
+            self.output_size = save_package(
+                self.doc.part.package, out,
+                level=self.options['compress-level'],
+                store_images=self.options['store-images'],
+                deflated=template_cache.get(self.template).deflated,
+            )
+            self.save_time = time.perf_counter() - started
+        return out
+
+    def to_bytes(self):
+        sink = ChunkSink()
+        self.save(sink)
+        return sink.getvalue()
+
+    def settings_signature(self):
+        return repr((
+            RESULT_CACHE_VERSION,
+            sorted(self.options.items()),
+            self.table_row_selectors,
+            self.table_style,
+            self.paragraph_style,
+            template_cache.key(self.template),
+        ))
+
+    def cache_key(self, html):
+        settings = self.settings_signature()
+        return content_hash(html.encode('utf-8', 'surrogatepass') + b'\0' + settings.encode('utf-8'))
+
+    def convert(self, html, out=None):
+        # Without out the document comes back as bytes in result.content,
+        # so nothing touches the filesystem. With a result_cache set, a
+        # repeat of the same input and settings skips conversion entirely.
+        key = self.cache_key(html) if self.result_cache is not None else None
+        result = self.cached_result(key, out)
+        if result is not None:
+            return result
+        self.set_initial_attrs()
+        with self.timed('total'):
+            with self.within_budget():
+                self.check_input(html)
+                self.run_process(html, self.meter)
+            return self.finish(key, out)
+
+    def current_image_digest(self, src):
+        # digest of the bytes a conversion would embed for src now, or None
+        # if that is only known by converting
+        if is_url(src):
+            data = self.image_cache.get(src) if self.image_cache is not None else None
+        else:
+            try:
+                with open(src, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                data = None
+        return image_digest(data) if data else None
+
+    def images_unchanged(self, sources):
+        # placeholders are never reused, so a failed image gets another try
+        return all(digest is not None and self.current_image_digest(src) == digest
+                   for src, digest in sources.items())
+
+    def image_key(self, key, digests):
+        return content_hash('\0'.join([key] + [src + '\0' + digest for src, digest in sorted(digests.items())])
+                            .encode('utf-8', 'surrogatepass'))
+
+    def cached_result(self, key, out):
+        content = self.result_cache.get(key) if key else None
+        if content is not None and content.startswith(IMAGE_MANIFEST):
+            digests = {src: self.current_image_digest(src) for src in json.loads(content[len(IMAGE_MANIFEST):])}
+            if None in digests.values():
+                content = None
+            else:
+                content = self.result_cache.get(self.image_key(key, digests))
+        if content is None:
+            return None
+        self.stats = ConversionStats(self.hooks) if self.instrument else None
+        if self.stats is not None:
+            self.stats.add('result_cache_hits')
+        return ConversionResult(None, output=write_output(out, content), content=content,
+                                cached=True, stats=self.stats, save_time=0.0, output_size=len(content))
+
+    def finish(self, key, out):
+        # saves the converted document to out, or to bytes when there is no
+        # out or the result has to be cached as well; partial results and
+        # documents with image placeholders are never cached
+        if self.budget_error is not None or None in self.image_sources.values():
+            key = None
+        if key is None and out is not None:
+            return ConversionResult(self.doc, output=self.save(out), stats=self.stats,
+                                    save_time=self.save_time, output_size=self.output_size, error=self.budget_error)
+        content = self.to_bytes()
+        if key and self.image_sources:
+            manifest = json.dumps(sorted(self.image_sources)).encode('utf-8', 'surrogatepass')
+            self.result_cache.put(key, IMAGE_MANIFEST + manifest)
+            self.result_cache.put(self.image_key(key, self.image_sources), content)
+        elif key:
+            self.result_cache.put(key, content)
+        return ConversionResult(self.doc, output=write_output(out, content), content=content, stats=self.stats,
+                                save_time=self.save_time, output_size=self.output_size, error=self.budget_error)
+
+
+def split_sections(html, parts):
+    # Top-level blocks grouped into at most about `parts` chunks of similar
+    # size. A chunk only ever starts at an h1/h2 or a top-level table,
+    # which open a fresh paragraph or table whatever came before them.
+    # <html>/<body> are dropped; they carry nothing the converter uses.
+    # Wrapper tags stay in the chunks, as blocks of their own.
+    blocks = []
+
+    def wrapper_start(tag, attrs):
+        if tag in wrapper_tags:
+            text = splitter.get_starttag_text()
+            blocks.append(text[:-2].rstrip() + '>' if text.endswith('/>') else text)
+
+    def wrapper_end(tag):
+        if tag in wrapper_tags:
+            blocks.append('</%s>' % tag)
+
+    splitter = BlockSplitter(blocks.append, wrapper_start, wrapper_end)
+    splitter.feed(html)
+    splitter.close()
+    target = max(1, sum(len(block) for block in blocks) // max(1, parts))
+    chunks, current, size = [], [], 0
+    for block in blocks:
+        if current and size >= target and SECTION_START.match(block):
+            chunks.append(''.join(current))
+            current, size = [], 0
+        current.append(block)
+        size += len(block)
+    if current:
+        chunks.append(''.join(current))
+    return chunks
+
+
+def convert_section(settings, html):
+    # Worker side of convert_parallel: (fragment, watermark texts, stats,
+    # budget usage, image sources, BudgetExceeded of a partial budget)
+    parser = HtmlToDocx()
+    parser.apply_settings(settings)
+    parser.set_initial_attrs()
+    with parser.within_budget():
+        parser.convert_blocks(html)
+    usage = parser.meter.usage() if parser.meter is not None else None
+    return (parser.export_fragment(0, with_state=False), parser.watermarks, parser.stats, usage,
+            parser.image_sources, parser.budget_error)
+
+
+def write_output(out, content):
+    # out is None, a path or a writable binary stream
+    if out is None:
+        return None
+    if isinstance(out, (str, os.PathLike)):
+        with open(out, 'wb') as f:
+            f.write(content)
+    else:
+        out.write(content)
+    return out
+
+
+html_extensions = ('.html', '.htm', '.xhtml')
+
+def collect_inputs(paths):
+    # Yields (source, relative name) pairs; the relative name keeps the
+    # layout of a directory argument when writing to an output directory.
+    seen = set()
+    for path in paths:
+        if os.path.isdir(path):
+            matches = []
+            for root, _, files in os.walk(path):
+                matches.extend(os.path.join(root, f) for f in files if f.lower().endswith(html_extensions))
+            pairs = [(m, os.path.relpath(m, path)) for m in sorted(matches)]
+        elif os.path.isfile(path):
+            pairs = [(path, os.path.basename(path))]
+        else:
+            pairs = [(m, os.path.basename(m)) for m in sorted(glob.glob(path, recursive=True)) if os.path.isfile(m)]
+        for source, name in pairs:
+            key = os.path.abspath(source)
+            if key not in seen:
+                seen.add(key)
+                yield source, name
+
+def output_path(source, name, output_dir=None):
+    if output_dir:
+        return os.path.join(output_dir, os.path.splitext(name)[0] + '.docx')
+    return os.path.splitext(source)[0] + '.docx'
+
+def is_up_to_date(source, target):
+    try:
+        return os.path.getmtime(target) >= os.path.getmtime(source)
+    except OSError:
+        return False
+
+worker_parser = None
+
+def init_worker(settings):
+    # One parser per process, so the template and image caches it warms
+    # here are reused for every file the process converts.
+    global worker_parser
+    worker_parser = HtmlToDocx()
+    worker_parser.apply_settings(settings)
+    template_cache.get(worker_parser.template)
+
+def convert_file(source, target, workers=1):
+    # workers > 1 splits this one file by section over that many processes
+    # The document is saved next to target and renamed over it, so a worker
+    # that dies mid-save leaves no truncated file that looks up to date.
+    started = time.perf_counter()
+    partial = None
+    try:
+        directory = os.path.dirname(target) or '.'
+        os.makedirs(directory, exist_ok=True)
+        prefix = '.' + os.path.basename(target)
+        # one per process; opened like target itself, so it gets the same mode
+        partial = os.path.join(directory, '%s.%d.part' % (prefix, os.getpid()))
+        with open(source, 'rb') as infile:
+            if workers > 1:
+                worker_parser.convert_parallel(infile.read().decode('utf-8', 'replace'), partial, workers)
+            else:
+                worker_parser.convert_stream(infile, partial)
+        os.replace(partial, target)
+        # left behind by earlier runs whose worker was killed
+        for stale in glob.glob(os.path.join(glob.escape(directory), glob.escape(prefix) + '*.part')):
+            os.remove(stale)
+    except Exception as e:
+        if partial is not None and os.path.exists(partial):
+            os.remove(partial)
+        return source, target, '%s: %s' % (type(e).__name__, e), time.perf_counter() - started
+    return source, target, None, time.perf_counter() - started
+
+def worker_result(future, source, target):
+    # a worker process that died (BrokenProcessPool) fails its file, not the batch
+    try:
+        return future.result()
+    except Exception as e:
+        return source, target, '%s: %s' % (type(e).__name__, e), 0.0
+
+def warmup(template=None, options=None):
+    # Pays the first-conversion costs (bs4, template load, style lookups,
+    # requests) up front, so a server can do it before taking traffic.
+    # Returns the seconds it took.
+    started = time.perf_counter()
+    parser = HtmlToDocx()
+    parser.template = template
+    parser.options.update(options or {})
+    parser.image_cache = None
+    parser.convert(WARMUP_HTML)
+    fetcher.open()
+    return time.perf_counter() - started
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='htmldocx', description='Convert HTML files to .docx')
+    parser.add_argument('inputs', nargs='+', help='HTML files, directories or glob patterns')
+    parser.add_argument('-o', '--output-dir', help='write documents here instead of next to each input')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1,
+                        help='worker processes; a single large file is split by section across them')
+    parser.add_argument('-f', '--force', action='store_true', help='convert even if the output is up to date')
+    parser.add_argument('--template', help='base .docx for every document')
+    parser.add_argument('--table-style', default=DEFAULT_TABLE_STYLE)
+    parser.add_argument('--paragraph-style', default=DEFAULT_PARAGRAPH_STYLE)
+    parser.add_argument('--no-images', action='store_true', help='leave images out')
+    parser.add_argument('--writer', choices=('docx', 'fast'), default='docx', help='paragraph/run writer backend')
+    parser.add_argument('--compress-level', type=int, choices=range(10), default=DEFAULT_COMPRESS_LEVEL,
+                        metavar='0-9', help='zip deflate level; 0 stores everything')
+    parser.add_argument('--store-images', action='store_true', help='store PNG/JPEG/GIF parts without recompressing')
+    args = parser.parse_args(argv)
+
+    settings = {
+        'options': {
+            'images': not args.no_images,
+            'writer': args.writer,
+            'compress-level': args.compress_level,
+            'store-images': args.store_images,
+        },
+        'table_style': args.table_style,
+        'paragraph_style': args.paragraph_style,
+        'template': args.template,
+    }
+    jobs, skipped = [], 0
+    for source, name in collect_inputs(args.inputs):
+        target = output_path(source, name, args.output_dir)
+        if not args.force and is_up_to_date(source, target):
+            skipped += 1
+        else:
+            jobs.append((source, target))
+
+    started = time.perf_counter()
+    failures, converted, input_bytes = [], 0, 0
+    if args.workers > 1 and len(jobs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(settings,))
+        futures = {pool.submit(convert_file, *job): job for job in jobs}
+        results = (worker_result(future, *futures[future]) for future in as_completed(futures))
+    else:
+        pool = None
+        init_worker(settings)
+        results = (convert_file(*job, workers=args.workers) for job in jobs)
+    try:
+        for source, target, error, elapsed in results:
+            if error:
+                failures.append((source, error))
+                print('FAILED %s: %s' % (source, error), file=sys.stderr)
+            else:
+                converted += 1
+                input_bytes += os.path.getsize(source)
+                print('%s -> %s (%.2fs)' % (source, target, elapsed))
+    finally:
+        if pool:
+            pool.shutdown()
+    elapsed = time.perf_counter() - started
+
+    print('%d converted, %d skipped, %d failed in %.2fs (%.1f files/s, %.1f KB/s)' % (
+        converted, skipped, len(failures), elapsed,
+        converted / elapsed if elapsed else 0.0,
+        input_bytes / 1024 / elapsed if elapsed else 0.0,
+    ))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
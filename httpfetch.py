@@ -0,0 +1,137 @@
+import threading
+import time
+
+from cache import LRUCache
+
+
+DEFAULT_POOL_SIZE = 16
+DEFAULT_TIMEOUT = 10
+DEFAULT_MAX_BYTES = 20 * 1024 * 1024
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+class FetchError(Exception):
+    pass
+
+
+class FetchTooLarge(FetchError):
+    pass
+
+
+class FetchResponse:
+
+    def __init__(self, url, status_code, content, headers, revalidated=False):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+        # True when the server answered 304 and content came from the cache
+        self.revalidated = revalidated
+
+    @property
+    def etag(self):
+        return self.headers.get('ETag')
+
+    @property
+    def last_modified(self):
+        return self.headers.get('Last-Modified')
+
+    @property
+    def validator(self):
+        return self.etag or self.last_modified
+
+    @property
+    def encoding(self):
+        from requests.utils import get_encoding_from_headers
+        return get_encoding_from_headers(self.headers) or 'utf-8'
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors='replace')
+
+
+class Fetcher:
+    # One pooled requests.Session shared by page and image fetches.
+    # Responses carrying an ETag or Last-Modified are kept (within a byte
+    # budget) and revalidated with a conditional GET on the next fetch.
+    # requests is imported with the first session, not with this module.
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 max_bytes=DEFAULT_MAX_BYTES, cache_bytes=DEFAULT_CACHE_BYTES):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.pool_size = pool_size
+        self._session = None
+        self.cache = LRUCache(cache_bytes, sizeof=lambda response: len(response.content))
+        self.revalidations = 0
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        return self.open()
+
+    def open(self):
+        # creates the pooled session on first use; warmup() calls it so the
+        # first fetch does not pay for importing requests
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+        return self._session
+
+    def fetch(self, url, timeout=None, max_bytes=None, deadline=None, cache=True):
+        import requests
+        timeout = timeout or self.timeout
+        max_bytes = max_bytes or self.max_bytes
+        if deadline:
+            timeout = max(0.001, min(timeout, deadline - time.monotonic()))
+        cached = self.cache.get(url) if cache else None
+        headers = {}
+        if cached is not None:
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+        try:
+            with self.session.get(url, headers=headers, timeout=timeout, stream=True) as response:
+                if response.status_code == 304 and cached is not None:
+                    with self._lock:
+                        self.revalidations += 1
+                    return FetchResponse(url, 200, cached.content, cached.headers, revalidated=True)
+                content = self.read(response, max_bytes, deadline)
+                result = FetchResponse(url, response.status_code, content, dict(response.headers))
+        except requests.RequestException as e:
+            raise FetchError('%s: %s' % (url, e)) from e
+        if cache and result.status_code == 200 and result.validator:
+            self.cache.put(url, result)
+        return result
+
+    def read(self, response, max_bytes, deadline=None):
+        length = response.headers.get('Content-Length')
+        if length and length.isdigit() and int(length) > max_bytes:
+            raise FetchTooLarge('%s is %s bytes' % (response.url, length))
+        chunks, size = [], 0
+        for chunk in response.iter_content(CHUNK_SIZE):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > max_bytes:
+                raise FetchTooLarge('%s exceeds %d bytes' % (response.url, max_bytes))
+            if deadline and time.monotonic() > deadline:
+                raise FetchError('%s: deadline exceeded' % response.url)
+        return b''.join(chunks)
+
+    def stats(self):
+        return {
+            'revalidations': self.revalidations,
+            'cache': self.cache.stats(),
+        }
+
+
+fetcher = Fetcher()
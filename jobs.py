@@ -0,0 +1,140 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_PENDING = 16
+DEFAULT_JOB_TTL = 600
+# finished jobs hold their result until fetched or expired; keep at most this many
+DEFAULT_MAX_FINISHED = 256
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+
+    def __init__(self, job_id):
+        self.id = job_id
+        self.future = None
+        self._state = 'queued'
+        self.result = None
+        self.error = None
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def state(self):
+        if self._state == 'queued' and self.future is not None and self.future.running():
+            return 'running'
+        return self._state
+
+    @property
+    def done(self):
+        return self._state in ('done', 'failed')
+
+    def timing(self):
+        timing = {}
+        if self.started_at:
+            timing['queued'] = self.started_at - self.queued_at
+        if self.finished_at:
+            timing['run'] = self.finished_at - self.started_at
+            timing['total'] = self.finished_at - self.queued_at
+        return timing
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'state': self.state,
+            'error': self.error,
+            'timing': self.timing(),
+        }
+
+
+def run_timed(fn, args):
+    # Runs in the worker (thread or process); timestamps are wall-clock so
+    # they line up with queued_at taken in the submitting process.
+    started = time.time()
+    result = fn(*args)
+    return started, time.time(), result
+
+
+class JobQueue:
+    # Bounded queue of conversion jobs. At most max_pending jobs may be
+    # queued or running; submit raises QueueFull beyond that so callers
+    # can push back instead of piling up work. Finished jobs are kept for
+    # ttl seconds, the oldest dropped first beyond max_finished.
+
+    def __init__(self, workers=DEFAULT_WORKERS, max_pending=DEFAULT_MAX_PENDING,
+                 ttl=DEFAULT_JOB_TTL, backend='thread', max_finished=DEFAULT_MAX_FINISHED):
+        if backend == 'thread':
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+        elif backend == 'process':
+            # a local stand-in for an out-of-process queue; fn and its
+            # arguments must be picklable
+            from concurrent.futures import ProcessPoolExecutor
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            raise ValueError('Unknown job backend %s' % backend)
+        self.backend = backend
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.max_finished = max_finished
+        self.jobs = {}
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise QueueFull('%d jobs already pending' % self.max_pending)
+        job = Job(uuid.uuid4().hex)
+        with self._lock:
+            self._expire()
+            self.jobs[job.id] = job
+        try:
+            future = self.executor.submit(run_timed, fn, args)
+        except Exception:
+            self._slots.release()
+            with self._lock:
+                del self.jobs[job.id]
+            raise
+        job.future = future
+        future.add_done_callback(lambda future: self._finish(job, future))
+        return job
+
+    def _finish(self, job, future):
+        try:
+            job.started_at, job.finished_at, job.result = future.result()
+            job._state = 'done'
+        except Exception as e:
+            job.error = '%s: %s' % (type(e).__name__, e)
+            job.finished_at = time.time()
+            job.started_at = job.started_at or job.finished_at
+            job._state = 'failed'
+        finally:
+            self._slots.release()
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        finished = sorted((j for j in self.jobs.values() if j.done), key=lambda job: job.finished_at)
+        excess = len(finished) - self.max_finished
+        for i, job in enumerate(finished):
+            if i < excess or job.finished_at < cutoff:
+                del self.jobs[job.id]
+
+    def get(self, job_id):
+        with self._lock:
+            self._expire()
+            return self.jobs.get(job_id)
+
+    def pending(self):
+        with self._lock:
+            self._expire()
+            return sum(1 for job in self.jobs.values() if not job.done)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
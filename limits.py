@@ -0,0 +1,137 @@
+import time
+
+
+# the conversion deadline is checked against the clock once per this many elements
+BUDGET_CLOCK_INTERVAL = 64
+
+
+class BudgetExceeded(ValueError):
+    # limit is the ConversionBudget limit that ran out: 'deadline',
+    # 'elements', 'table_cells', 'image_bytes' or 'depth'
+
+    def __init__(self, limit, used, maximum):
+        super().__init__(limit, used, maximum)
+        self.limit = limit
+        self.used = used
+        self.maximum = maximum
+
+    def __str__(self):
+        if self.limit == 'deadline':
+            return 'Conversion did not finish within %gs' % self.maximum
+        return 'Conversion exceeded its %s limit (%d > %d)' % (self.limit.replace('_', ' '), self.used, self.maximum)
+
+
+class ConversionBudget:
+    # Limits for converting untrusted input; None turns a limit off.
+    # deadline is in seconds from the start of the conversion,
+    # input_bytes is the size of the HTML (UTF-8), checked before it is
+    # parsed, and image_bytes counts every image loaded, fetched or from
+    # the cache.
+    # A conversion that runs out raises BudgetExceeded, or with partial
+    # set stops there and returns what it has (result.partial).
+
+    def __init__(self, deadline=None, elements=None, table_cells=None, image_bytes=None, depth=None,
+                 partial=False, input_bytes=None):
+        self.deadline = deadline
+        self.input_bytes = input_bytes
+        self.elements = elements
+        self.table_cells = table_cells
+        self.image_bytes = image_bytes
+        self.depth = depth
+        self.partial = partial
+
+    def meter(self):
+        return BudgetMeter(self)
+
+
+class BudgetMeter:
+    # What one conversion has used of its budget. Child parsers for table
+    # cells take the running meter as their budget, and meter() hands back
+    # the same object, so the whole document draws on one allowance.
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.partial = budget.partial
+        self.expires = time.monotonic() + budget.deadline if budget.deadline is not None else None
+        self.input_bytes = 0
+        self.elements = 0
+        self.table_cells = 0
+        self.image_bytes = 0
+        # start tags seen by the tokenizer, ahead of the tree being built
+        self.scanned = 0
+
+    def meter(self):
+        return self
+
+    def remaining(self):
+        # seconds left before the deadline, None without one
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.monotonic())
+
+    def check_deadline(self):
+        if self.expires is not None and time.monotonic() >= self.expires:
+            raise BudgetExceeded('deadline', self.budget.deadline, self.budget.deadline)
+
+    def element(self):
+        self.elements += 1
+        if self.budget.elements is not None and self.elements > self.budget.elements:
+            raise BudgetExceeded('elements', self.elements, self.budget.elements)
+        if not self.elements % BUDGET_CLOCK_INTERVAL:
+            self.check_deadline()
+
+    def read(self, size):
+        # input as it arrives, before any of it is parsed
+        self.input_bytes += size
+        if self.budget.input_bytes is not None and self.input_bytes > self.budget.input_bytes:
+            raise BudgetExceeded('input_bytes', self.input_bytes, self.budget.input_bytes)
+
+    def scan(self):
+        # Called for each start tag while tokenizing, so an oversized or
+        # slow document stops before bs4 builds a tree for it. Counted
+        # apart from elements, which converted elements are charged to.
+        self.scanned += 1
+        if self.budget.elements is not None and self.scanned > self.budget.elements:
+            raise BudgetExceeded('elements', self.scanned, self.budget.elements)
+        if not self.scanned % BUDGET_CLOCK_INTERVAL:
+            self.check_deadline()
+
+    def enter(self, depth):
+        if self.budget.depth is not None and depth > self.budget.depth:
+            raise BudgetExceeded('depth', depth, self.budget.depth)
+
+    def add(self, limit, amount):
+        # limit is 'table_cells' or 'image_bytes'
+        used = getattr(self, limit) + amount
+        setattr(self, limit, used)
+        maximum = getattr(self.budget, limit)
+        if maximum is not None and used > maximum:
+            raise BudgetExceeded(limit, used, maximum)
+        self.check_deadline()
+
+    def usage(self):
+        return {'elements': self.elements, 'table_cells': self.table_cells, 'image_bytes': self.image_bytes}
+
+    def add_usage(self, usage):
+        # counts work done elsewhere (section workers) against this meter
+        self.elements += usage['elements']
+        if self.budget.elements is not None and self.elements > self.budget.elements:
+            raise BudgetExceeded('elements', self.elements, self.budget.elements)
+        self.add('table_cells', usage['table_cells'])
+        self.add('image_bytes', usage['image_bytes'])
+
+    def remaining_budget(self):
+        # what is left, as a budget for a section worker
+        def left(maximum, used):
+            return None if maximum is None else max(0, maximum - used)
+        budget = self.budget
+        return ConversionBudget(
+            deadline=self.remaining(),
+            elements=left(budget.elements, self.elements),
+            table_cells=left(budget.table_cells, self.table_cells),
+            image_bytes=left(budget.image_bytes, self.image_bytes),
+            depth=budget.depth,
+            partial=budget.partial,
+            # the whole input was measured before it was split
+            input_bytes=None,
+        )
@@ -0,0 +1,127 @@
+import os
+import struct
+import time
+import zlib
+
+from docx.opc.packuri import CONTENT_TYPES_URI, PACKAGE_URI
+from docx.opc.pkgwriter import _ContentTypesItem
+
+
+DEFAULT_COMPRESS_LEVEL = 6
+# formats that are already compressed gain nothing from deflate
+PRECOMPRESSED_CONTENT_TYPES = {
+    'image/png', 'image/jpeg', 'image/gif', 'image/jpg', 'image/pjpeg', 'image/x-png',
+}
+ZIP_LIMIT = 0xFFFFFFFF
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP_VERSION = 20
+ZIP_MADE_BY = (3 << 8) | ZIP_VERSION
+ZIP_FILE_ATTRS = 0o600 << 16
+
+
+def deflate(data, level=DEFAULT_COMPRESS_LEVEL):
+    # raw deflate stream, as stored in a zip member
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+def dos_time(timestamp=None):
+    year, month, day, hour, minute, second = time.localtime(timestamp)[:6]
+    return ((year - 1980) << 9) | (month << 5) | day, (hour << 11) | (minute << 5) | (second // 2)
+
+
+class ZipWriter:
+    # Minimal forward-only zip writer. Members are compressed in memory
+    # before their header is written, so the target only needs write();
+    # callers may also hand in an already-deflated member.
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.offset = 0
+        self.entries = []
+        self.date, self.time = dos_time()
+
+    def _write(self, data):
+        self.fp.write(data)
+        self.offset += len(data)
+
+    def write(self, name, data, level=DEFAULT_COMPRESS_LEVEL, deflated=None):
+        # deflated is (crc, raw deflate bytes) for data, if already known
+        if deflated is not None:
+            method = ZIP_DEFLATED
+            crc, payload = deflated
+        elif level:
+            method = ZIP_DEFLATED
+            crc, payload = zlib.crc32(data), deflate(data, level)
+        else:
+            method = ZIP_STORED
+            crc, payload = zlib.crc32(data), data
+        if len(data) > ZIP_LIMIT or self.offset > ZIP_LIMIT:
+            raise ValueError('Package too large for a zip without zip64')
+        name = name.encode('utf-8')
+        entry = (name, method, crc, len(payload), len(data), self.offset)
+        self._write(struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, ZIP_VERSION, 0, method, self.time, self.date,
+            crc, len(payload), len(data), len(name), 0,
+        ) + name)
+        self._write(payload)
+        self.entries.append(entry)
+
+    def close(self):
+        start = self.offset
+        for name, method, crc, compressed_size, size, offset in self.entries:
+            self._write(struct.pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50, ZIP_MADE_BY, ZIP_VERSION, 0, method,
+                self.time, self.date, crc, compressed_size, size, len(name), 0, 0, 0, 0,
+                ZIP_FILE_ATTRS, offset,
+            ) + name)
+        self._write(struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, len(self.entries), len(self.entries),
+            self.offset - start, start, 0,
+        ))
+        return self.offset
+
+
+class ChunkSink:
+    # Write target that keeps the written blocks, so the finished package
+    # is joined into bytes once instead of growing a BytesIO.
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+        return len(data)
+
+    def getvalue(self):
+        return b''.join(self.chunks)
+
+
+def write_package(package, fp, level=DEFAULT_COMPRESS_LEVEL, store_images=False, deflated=None):
+    # Same members and order as python-docx's PackageWriter. deflated is
+    # an optional deflated(blob, level) returning (crc, raw) for blobs
+    # whose compressed form is already known, or None.
+    for part in package.parts:
+        part.before_marshal()
+    parts = list(package.parts)
+    writer = ZipWriter(fp)
+    writer.write(CONTENT_TYPES_URI.membername, _ContentTypesItem.from_parts(parts).blob, level)
+    writer.write(PACKAGE_URI.rels_uri.membername, package.rels.xml, level)
+    for part in parts:
+        blob = part.blob
+        part_level = 0 if store_images and part.content_type in PRECOMPRESSED_CONTENT_TYPES else level
+        known = deflated(blob, part_level) if deflated is not None and part_level else None
+        writer.write(part.partname.membername, blob, part_level, known)
+        if len(part._rels):
+            writer.write(part.partname.rels_uri.membername, part._rels.xml, level)
+    return writer.close()
+
+
+def save_package(package, out, level=DEFAULT_COMPRESS_LEVEL, store_images=False, deflated=None):
+    # out is a path or any writable binary stream (it need not be
+    # seekable); returns the number of bytes written
+    if isinstance(out, (str, os.PathLike)):
+        with open(out, 'wb') as fp:
+            return write_package(package, fp, level, store_images, deflated)
+    return write_package(package, out, level, store_images, deflated)
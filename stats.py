@@ -0,0 +1,50 @@
+import contextlib
+import time
+
+
+class ConversionStats:
+    # Filled in while HtmlToDocx.instrument is on. timers hold seconds per
+    # phase, tags the number of start tags handled per tag name, counters
+    # everything else. Each hook is called as hook(phase, seconds) when a
+    # timed phase ends.
+
+    def __init__(self, hooks=()):
+        self.timers = {}
+        self.tags = {}
+        self.counters = {}
+        self.hooks = list(hooks)
+        self._depth = {}
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        # nested timers for the same phase (tables in tables) count once
+        depth = self._depth.get(phase, 0)
+        self._depth[phase] = depth + 1
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._depth[phase] = depth
+            if not depth:
+                elapsed = time.perf_counter() - started
+                self.timers[phase] = self.timers.get(phase, 0.0) + elapsed
+                for hook in self.hooks:
+                    hook(phase, elapsed)
+
+    def count_tag(self, tag):
+        self.tags[tag] = self.tags.get(tag, 0) + 1
+
+    def add(self, counter, value=1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def merge(self, other):
+        for mine, theirs in ((self.timers, other.timers), (self.tags, other.tags), (self.counters, other.counters)):
+            for key, value in theirs.items():
+                mine[key] = mine.get(key, 0) + value
+
+    def to_dict(self):
+        return {
+            'timers': dict(self.timers),
+            'tags': dict(self.tags),
+            'counters': dict(self.counters),
+        }
@@ -0,0 +1,69 @@
+import pytest
+from lxml import etree
+
+from htmldocx import HtmlToDocx
+
+
+CASES = {
+    'spans': (
+        '<p>plain <span style="color: red">red</span> '
+        '<span style="background-color: yellow; font-family: Courier">marked</span> '
+        '<span style="color: #336699">hex <b>bold</b></span> '
+        '<span style="color: rgb(200, 30, 30)">rgb</span></p>'
+    ),
+    'bold_italic_underline': (
+        '<p><b>b</b> <i>i</i> <u>u</u> <strong><em>both</em></strong> '
+        '<b><i><u>all</u></i></b> <s>s</s> <sup>sup</sup><sub>sub</sub> <code>code</code></p>'
+    ),
+    'alignment_and_indent': (
+        '<p style="text-align: center">centred</p>'
+        '<p style="text-align: right; margin-left: 20px">right</p>'
+        '<blockquote>quoted</blockquote>'
+    ),
+    'headings': ''.join('<h%d>Heading %d</h%d><p>body</p>' % (n, n, n) for n in range(1, 7)),
+    'lists': (
+        '<ul><li>one</li><li>two<ol><li>nested <b>bold</b></li><li>nested two</li></ol></li></ul>'
+        '<ol><li>first</li><li>second<ul><li>deep<ul><li>deeper</li></ul></li></ul></li></ol>'
+    ),
+    'hr_and_br': '<p>before</p><hr><p>line<br>break<br><br>twice</p><br><p>after</p>',
+    'pre': '<pre>  indented\n    more\nback</pre>',
+    'links': '<p>see <a href="https://example.com/a">one <b>bold</b></a> and <a href="https://example.com/b">two</a></p>',
+    'tables': (
+        '<table><tr><th>head</th><th style="color: blue">blue</th></tr>'
+        '<tr><td><b>cell</b> text</td><td><ul><li>item</li></ul></td></tr>'
+        '<tr><td><h2>heading</h2><hr></td><td><table><tr><td>nested</td></tr></table></td></tr></table>'
+    ),
+    'watermark': '<p>text</p><div id="watermark">DRAFT</div><p>more</p>',
+    'loose_text': 'loose <i>text</i> outside blocks<p>then a paragraph</p>tail',
+}
+
+
+def convert(html, writer, paragraph_style=None):
+    parser = HtmlToDocx()
+    parser.options['writer'] = writer
+    parser.options['images'] = False
+    parser.paragraph_style = paragraph_style
+    document = parser.convert(html).document
+    return (
+        etree.tostring(document.element.body, method='c14n'),
+        [etree.tostring(section.footer._element, method='c14n') for section in document.sections],
+    )
+
+
+@pytest.mark.parametrize('paragraph_style', [None, 'Body Text'])
+@pytest.mark.parametrize('name', sorted(CASES))
+def test_fast_writer_matches_docx_writer(name, paragraph_style):
+    body, footers = convert(CASES[name], 'docx', paragraph_style)
+    fast_body, fast_footers = convert(CASES[name], 'fast', paragraph_style)
+    assert fast_body == body
+    assert fast_footers == footers
+
+
+def test_fast_writer_matches_docx_writer_for_all_cases_together():
+    html = ''.join(CASES[name] for name in sorted(CASES))
+    assert convert(html, 'fast') == convert(html, 'docx')
+
+
+def test_watermark_is_written_to_the_footer():
+    _, footers = convert(CASES['watermark'], 'fast')
+    assert any(b'DRAFT' in footer for footer in footers)
@@ -0,0 +1,125 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from httpfetch import FetchError, FetchTooLarge, Fetcher
+
+
+PAGE = b'<p>cached page</p>'
+LAST_MODIFIED = 'Wed, 01 Jan 2025 00:00:00 GMT'
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, headers=()):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunks(self, chunks, delay=0):
+        # no Content-Length: the size is only known while reading
+        self.send_response(200)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for chunk in chunks:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                self.wfile.flush()
+                time.sleep(delay)
+            self.wfile.write(b'0\r\n\r\n')
+        except ConnectionError:
+            # the fetcher gave up on the body
+            self.close_connection = True
+
+    def not_modified(self):
+        self.send_response(304)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.path == '/etag':
+            if self.headers.get('If-None-Match') == '"v1"':
+                return self.not_modified()
+            self.send_body(PAGE, [('ETag', '"v1"')])
+        elif self.path == '/last-modified':
+            if self.headers.get('If-Modified-Since') == LAST_MODIFIED:
+                return self.not_modified()
+            self.send_body(PAGE, [('Last-Modified', LAST_MODIFIED)])
+        elif self.path == '/large':
+            self.send_body(b'x' * 4096)
+        elif self.path == '/streamed':
+            self.send_chunks([b'x' * 1024] * 4)
+        elif self.path == '/slow':
+            self.send_chunks([b'x' * 16] * 20, delay=0.05)
+        else:
+            self.send_error(404)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.daemon_threads = True
+    httpd.requests = []
+    thread = threading.Thread(target=httpd.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    httpd.base = 'http://127.0.0.1:%d' % httpd.server_address[1]
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.mark.parametrize('path, header', [('/etag', 'If-None-Match'), ('/last-modified', 'If-Modified-Since')])
+def test_revalidated_response_serves_stored_body(server, path, header):
+    fetcher = Fetcher()
+    first = fetcher.fetch(server.base + path)
+    assert first.status_code == 200
+    assert first.content == PAGE
+    assert not first.revalidated
+    assert header not in server.requests[0][1]
+
+    second = fetcher.fetch(server.base + path)
+    assert header in server.requests[1][1]
+    assert second.revalidated
+    assert second.status_code == 200
+    assert second.content == PAGE
+    assert second.text == PAGE.decode('utf-8')
+    assert fetcher.stats()['revalidations'] == 1
+
+
+def test_uncached_fetch_is_unconditional(server):
+    fetcher = Fetcher()
+    fetcher.fetch(server.base + '/etag', cache=False)
+    response = fetcher.fetch(server.base + '/etag')
+    assert 'If-None-Match' not in server.requests[1][1]
+    assert not response.revalidated
+    assert fetcher.revalidations == 0
+
+
+def test_too_large_by_content_length(server):
+    with pytest.raises(FetchTooLarge, match='4096 bytes'):
+        Fetcher(max_bytes=1024).fetch(server.base + '/large')
+
+
+def test_too_large_while_streaming(server):
+    with pytest.raises(FetchTooLarge, match='exceeds 2048 bytes'):
+        Fetcher(max_bytes=2048).fetch(server.base + '/streamed')
+    assert Fetcher(max_bytes=4096).fetch(server.base + '/streamed').content == b'x' * 4096
+
+
+def test_deadline_stops_a_slow_body(server):
+    started = time.monotonic()
+    with pytest.raises(FetchError, match='deadline exceeded'):
+        Fetcher().fetch(server.base + '/slow', deadline=started + 0.3)
+    # the body takes a second to arrive; the fetch gives up well before
+    assert time.monotonic() - started < 0.8
@@ -0,0 +1,84 @@
+import base64
+import io
+import struct
+import zipfile
+import zlib
+
+import pytest
+from docx import Document
+
+from htmldocx import HtmlToDocx
+
+
+def png(width=4, height=4):
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    rows = b''.join(b'\0' + b'\xff\x00\x00' * width for _ in range(height))
+    return (
+        b'\x89PNG\r\n\x1a\n'
+        + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        + chunk(b'IDAT', zlib.compress(rows))
+        + chunk(b'IEND', b'')
+    )
+
+
+HTML = (
+    '<h1>Title</h1><p>some <b>bold</b> text</p>'
+    '<table><tr><td>cell</td></tr></table>'
+    '<p><img src="data:image/png;base64,%s"></p>' % base64.b64encode(png()).decode('ascii')
+)
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpeg', '.jpg', '.gif')
+
+
+class NonSeekable:
+    # a pipe-like target: write() only
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+    def seekable(self):
+        return False
+
+    def getvalue(self):
+        return self.buffer.getvalue()
+
+
+@pytest.mark.parametrize('target', ['path', 'stream'])
+@pytest.mark.parametrize('store_images', [False, True])
+@pytest.mark.parametrize('level', [0, 1, 6, 9])
+def test_saved_package_is_a_valid_docx(tmp_path, level, store_images, target):
+    parser = HtmlToDocx()
+    parser.options['compress-level'] = level
+    parser.options['store-images'] = store_images
+    if target == 'path':
+        out = str(tmp_path / 'out.docx')
+        result = parser.convert(HTML, out)
+        with open(out, 'rb') as f:
+            content = f.read()
+    else:
+        out = NonSeekable()
+        result = parser.convert(HTML, out)
+        content = out.getvalue()
+    assert result.output_size == len(content)
+
+    with zipfile.ZipFile(io.BytesIO(content)) as package:
+        assert package.testzip() is None
+        members = package.infolist()
+        assert len([member for member in members if member.filename.startswith('word/media/')]) == 1
+        for member in members:
+            # the embedded PNG and the template's JPEG thumbnail
+            is_image = member.filename.endswith(IMAGE_EXTENSIONS)
+            if level == 0 or (store_images and is_image):
+                assert member.compress_type == zipfile.ZIP_STORED
+            else:
+                assert member.compress_type == zipfile.ZIP_DEFLATED
+
+    document = Document(io.BytesIO(content))
+    assert document.paragraphs[0].text == 'Title'
+    assert document.tables[0].cell(0, 0).text == 'cell'
+    assert len(document.inline_shapes) == 1